@@ -3,22 +3,34 @@
 # Preserves original output and variable names, but is more robust & readable.
 
 import os
-import pandas as pd
+import io
+import csv
+import json
+import codecs
+import time
+import hashlib
 import datetime
-from datetime import timedelta
+import threading
+import contextlib
+import tracemalloc
+import concurrent.futures
 
 # -------------------------
 # Configuration (edit if needed)
 # -------------------------
-directory = r'C:\Users\Olivier\OneDrive - University of Ottawa\Desktop\GitHub\phd-scripts\python\adherence_report'
-raw_dir = os.path.join(directory, "raw")
-output_file = os.path.join(directory, "output", "adherence_report.csv")
-os.makedirs(os.path.dirname(output_file), exist_ok=True)
+# default cohort folder (raw/ and output/ next to this script); other folders can be given on the command line
+directory = os.path.dirname(os.path.abspath(__file__))
 
-# input filenames (as in original)
-mbi_file = os.path.join(raw_dir, "MBIProjectPhase2.csv")
-outcome_file = os.path.join(raw_dir, "Outcome_complete.csv")
-partner_file = os.path.join(raw_dir, "PartnerReport.csv")
+def input_paths(directory):
+    """Raw input files and report path of one cohort folder (raw/ and output/ as in the original)."""
+    raw_dir = os.path.join(directory, "raw")
+    return {
+        'mbi_file': os.path.join(raw_dir, "MBIProjectPhase2.csv"),
+        'outcome_file': os.path.join(raw_dir, "Outcome_complete.csv"),
+        'partner_file': os.path.join(raw_dir, "PartnerReport.csv"),
+        'output_file': os.path.join(directory, "output", "adherence_report.csv"),
+        'vitals_file': os.path.join(directory, "output", "adherence_vitals.csv"),
+    }
 
 # constants (matching original)
 DURATION_CAP = 3600
@@ -30,591 +42,1989 @@ mod1 = 2145
 mod2 = 3294
 mod3 = 2522
 mod4 = 2727
-avg_weekly = 2672 * 0.7        # same as original
-avg_weekly_con = 2400 * 0.7
+weekly_len = 2672
+weekly_len_con = 2400
+avg_weekly = weekly_len * 0.7        # same as original
+avg_weekly_con = weekly_len_con * 0.7
 control_len = 9600
 seventypercent_controllen = control_len * 0.7
+# adherence windows in days since each participant's first session: window k covers [edges[k-1], edges[k]).
+# Original protocol: wk1-wk3 are 7-day windows and wk4 runs from day 21 to day 56; the overall
+# total counts sessions before the last edge. e.g. 8 weekly windows: list(range(0, 57, 7))
+WINDOW_EDGES_DAYS = [0, 7, 14, 21, 56]
+# rows per PartnerReport chunk; None loads the file at once, a number (e.g. 200000) streams it
+# through per-participant running aggregates so memory stays flat for multi-GB exports
+PARTNER_CHUNKSIZE = None
+# folder (relative to the cohort directory) for incremental-run state (per-day aggregates, per-sid
+# totals, watermark); the next run only ingests rows appended to PartnerReport since then.
+# None always rebuilds from scratch
+INCREMENTAL_STATE_SUBDIR = os.path.join("output", "state")
+# snapshot deltas keep the original timedelta.seconds wrap-around (finish before start -> 86400 - x);
+# set False for true elapsed seconds
+SNAPSHOT_LEGACY_SECONDS = True
+# parsed copies of the raw CSVs are cached in this folder next to each CSV (Feather if pyarrow is
+# installed, pickle otherwise) and reused until the CSV changes; None always parses the CSVs
+CSV_CACHE_DIRNAME = ".csv_cache"
+# multi-cohort runs: one folder per site/cohort (each with raw/ and output/); when set, every cohort is
+# processed in its own worker process and a combined report is written next to the default report
+COHORT_DIRECTORIES = []
+# split one large PartnerReport into this many row ranges folded in parallel (None = single process)
+PARTNER_SHARDS = None
+# worker processes for cohorts/shards (None = number of CPUs)
+MAX_WORKERS = None
+# the three raw inputs of a cohort are read by up to INPUT_THREADS threads at once (1, or PROFILE_MODE set =
+# one after another in the main thread); before that, the header line and the next INPUT_PROBE_BYTES of
+# every file are decoded so that a missing file, a wrong encoding or a missing column fails the run before
+# any parsing starts
+INPUT_THREADS = 3
+INPUT_PROBE_BYTES = 1 << 16
+# also write output/coercion_report.csv: per input column the blank, invalid and substituted (0 / sentinel
+# date) cells and the first COERCION_SAMPLE_ROWS rows concerned (counted while the inputs are converted)
+COERCION_REPORT = False
+COERCION_SAMPLE_ROWS = 5
+
+# report formats: 'legacy' (original header-in-row CSV), 'tidy' (one row per participant, CSV),
+# 'parquet', 'feather' (tidy, need pyarrow); rows are written REPORT_CHUNK_ROWS at a time
+REPORT_FORMATS = ['legacy']
+REPORT_CHUNK_ROWS = 50000
+
+# per-stage run log written to output/<RUN_LOG_NAME>.json (latest run) and appended to .csv (None = off)
+RUN_LOG_NAME = "run_log"
+# opt-in profiling of a run: None, 'cprofile' or 'tracemalloc' (top PROFILE_TOP hot spots to output/)
+PROFILE_MODE = None
+PROFILE_TOP = 25
+
+# settings that can be overridden at run time (command line); worker processes receive the same values
+SETTINGS = ['DURATION_CAP', 'seventypercent_mod1to4', 'seventypercent_controllen', 'avg_weekly', 'avg_weekly_con',
+            'WINDOW_EDGES_DAYS', 'PARTNER_CHUNKSIZE', 'INCREMENTAL_STATE_SUBDIR', 'SNAPSHOT_LEGACY_SECONDS',
+            'CSV_CACHE_DIRNAME', 'RUN_LOG_NAME', 'PROFILE_MODE', 'REPORT_FORMATS', 'REPORT_CHUNK_ROWS',
+            'INPUT_THREADS', 'INPUT_PROBE_BYTES', 'COERCION_REPORT', 'COERCION_SAMPLE_ROWS']
+
+def current_settings():
+    """Current values of SETTINGS."""
+    return {name: globals()[name] for name in SETTINGS}
+
+def apply_settings(settings):
+    """Override module settings (also used as the process-pool initializer)."""
+    globals().update(settings)
 
 # -------------------------
-# Helper utilities
+# Run instrumentation: time, rows, participants and peak memory of every pipeline stage
 # -------------------------
-def safe_read_csv(path, encoding="utf-8"):
-    """Read CSV robustly as strings (keeps header row intact)."""
-    return pd.read_csv(path, dtype=str, encoding=encoding, keep_default_na=False)
+# stage name -> totals over the run (streamed/sharded stages run once per chunk and are summed)
+STAGE_STATS = {}
+STAGE_COLUMNS = ['stage', 'calls', 'seconds', 'rows_in', 'rows_out', 'participants', 'peak_mib']
+# stages (and CSV cache counts) are recorded from the input-reading threads as well
+STATS_LOCK = threading.Lock()
 
-def parse_ymd_datestring(s):
-    """Try to coerce input date string to datetime.date using formats like YYYY/MM/DD or YYYY-MM-DD.
-       Returns datetime.date or None."""
-    if s is None:
-        return None
-    s = str(s).strip()
-    if s == "":
-        return None
-    # replace '-' with '/' to mimic original script's replacement
-    s2 = s.replace("-", "/")
-    # try parsing "%Y/%m/%d"
-    try:
-        return datetime.datetime.strptime(s2, "%Y/%m/%d").date()
-    except Exception:
-        # try a few fallbacks
-        for fmt in ("%Y/%m/%d %H:%M:%S", "%Y/%m/%d/%H/%M/%S", "%Y/%m/%dT%H:%M:%S%z"):
-            try:
-                return datetime.datetime.strptime(s2, fmt).date()
-            except Exception:
-                continue
-    return None
-
-def snapshot_to_standard(s):
-    """Apply transformations similar to clean_snapshot in original script:
-       remove timezone suffixes (+00:00, -04:00, -06:00), replace 'T' with '/', '-' and ':' with '/'.
-       Returns transformed string or 'null' if missing/invalid."""
+def max_rss_bytes():
+    """High-water resident memory of this process, or None where the platform does not report it."""
     try:
-        if not s or pd.isna(s):
-            return "null"
-        s = str(s)
-        # strip timezone segments as original did
-        for tz in ["+00:00", "-04:00", "-06:00"]:
-            if s.endswith(tz):
-                # original strips the timezone digits then +/- char; emulate by removing tz
-                s = s[:-len(tz)]
-                # also strip possible trailing + or - left
-                s = s.rstrip("+-")
-        # replace characters
-        s = s.replace("T", "/").replace("-", "/").replace(":", "/")
-        if s.strip() == "":
-            return "null"
-        return s
-    except Exception:
-        return "null"
+        import resource
+    except ImportError:  # Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if os.uname().sysname == 'Darwin' else peak * 1024
+
+def memory_source():
+    """What the peak_mib column measures in this process."""
+    if PROFILE_MODE == 'tracemalloc' and tracemalloc.is_tracing():
+        return 'tracemalloc peak above the start of the stage'
+    return 'process max RSS at the end of the stage' if max_rss_bytes() is not None else None
 
-def parse_snapshot_datetime(s):
-    """Expect strings like 'YYYY/MM/DD/H/M/S' and return a datetime, else return a fallback sentinel."""
+def record_stage(name, calls, seconds, rows_in=None, rows_out=None, participants=None, peak_mib=None):
+    """Add one measurement (or a worker's totals) to STAGE_STATS: calls, seconds and rows are summed,
+       participants and peak memory keep the maximum."""
+    with STATS_LOCK:
+        entry = STAGE_STATS.setdefault(name, dict.fromkeys(STAGE_COLUMNS[1:]) | {'calls': 0, 'seconds': 0.0})
+        entry['calls'] += calls
+        entry['seconds'] += seconds
+        for key, value in [('rows_in', rows_in), ('rows_out', rows_out)]:
+            if value is not None:
+                entry[key] = (entry[key] or 0) + value
+        for key, value in [('participants', participants), ('peak_mib', peak_mib)]:
+            if value is not None:
+                entry[key] = value if entry[key] is None else max(entry[key], value)
+
+def merge_stage_stats(stats):
+    """Fold the STAGE_STATS of a worker process into this one."""
+    for name, entry in stats.items():
+        record_stage(name, entry['calls'], entry['seconds'], entry['rows_in'], entry['rows_out'],
+                     entry['participants'], entry['peak_mib'])
+
+@contextlib.contextmanager
+def stage(name, rows_in=None, participants=None):
+    """Time the enclosed block as one call of stage name. The block may set info['rows_out'] and
+       info['participants'] (info['calls'] = 0 records the time without counting a call).
+       Stages do not nest: under --profile tracemalloc each stage resets the traced peak (tracing
+       started by someone else, e.g. the benchmark suite, is left alone). Peaks are per process, so
+       stages running in the input-reading threads at the same time share them."""
+    info = {'rows_out': None, 'participants': participants, 'calls': 1}
+    tracing = PROFILE_MODE == 'tracemalloc' and tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.reset_peak()
+        start_traced = tracemalloc.get_traced_memory()[0]
+    t0 = time.perf_counter()
     try:
-        if s in (None, "", "null"):
-            # return sentinel datetime far in past (original used '1111/11/11/11/11/11')
-            return datetime.datetime.strptime("1111/11/11/11/11/11", "%Y/%m/%d/%H/%M/%S")
-        return datetime.datetime.strptime(s, "%Y/%m/%d/%H/%M/%S")
-    except Exception:
-        # fallback sentinel
-        return datetime.datetime.strptime("1111/11/11/11/11/11", "%Y/%m/%d/%H/%M/%S")
+        yield info
+    finally:
+        seconds = time.perf_counter() - t0
+        peak = tracemalloc.get_traced_memory()[1] - start_traced if tracing else max_rss_bytes()
+        record_stage(name, info['calls'], seconds, rows_in, info['rows_out'], info['participants'],
+                     None if peak is None else round(peak / 2**20, 3))
+
+def write_run_log(output_dir, run, stats=None):
+    """Write a run's stage table to output_dir/RUN_LOG_NAME.json (latest run, with the run metadata)
+       and append it to RUN_LOG_NAME.csv (one row per stage and run, for comparing nightly runs)."""
+    if not RUN_LOG_NAME:
+        return
+    stats = STAGE_STATS if stats is None else stats
+    rows = [{'stage': name, **{k: entry[k] for k in STAGE_COLUMNS[1:]}} for name, entry in stats.items()]
+    for row in rows:
+        row['seconds'] = round(row['seconds'], 6)
+    os.makedirs(output_dir, exist_ok=True)
+    with open(os.path.join(output_dir, RUN_LOG_NAME + ".json"), 'w') as f:
+        json.dump({**run, 'settings': current_settings(), 'stages': rows}, f, indent=2, default=str)
+    csv_file = os.path.join(output_dir, RUN_LOG_NAME + ".csv")
+    new_file = not os.path.exists(csv_file)
+    with open(csv_file, 'a', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=['started', 'directory'] + STAGE_COLUMNS)
+        if new_file:
+            writer.writeheader()
+        for row in rows:
+            writer.writerow({'started': run.get('started'), 'directory': run.get('directory'), **row})
+
+@contextlib.contextmanager
+def profiled(mode, output_dir, top=None):
+    """Run the enclosed block under cProfile or tracemalloc (mode 'cprofile'/'tracemalloc', None = off)
+       and write the top hot spots to output_dir/profile_top.txt (plus profile.prof for cProfile)."""
+    if not mode:
+        yield
+        return
+    if mode not in ('cprofile', 'tracemalloc'):
+        raise ValueError(f"unknown profile mode {mode!r} (use 'cprofile' or 'tracemalloc')")
+    top = top or PROFILE_TOP
+    os.makedirs(output_dir, exist_ok=True)
+    top_file = os.path.join(output_dir, "profile_top.txt")
+    if mode == 'cprofile':
+        import cProfile
+        import pstats
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(os.path.join(output_dir, "profile.prof"))
+            text = io.StringIO()
+            pstats.Stats(profiler, stream=text).sort_stats('cumulative').print_stats(top)
+            with open(top_file, 'w') as f:
+                f.write(text.getvalue())
+    else:
+        tracemalloc.start(10)
+        try:
+            yield
+        finally:
+            snapshot = tracemalloc.take_snapshot().filter_traces([
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>")])
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            lines = [f"traced memory: current {current / 2**20:.1f} MiB, peak {peak / 2**20:.1f} MiB",
+                     f"top {top} allocation sites still held at the end of the run (imports excluded):"]
+            lines += [str(s) for s in snapshot.statistics('lineno')[:top]]
+            with open(top_file, 'w') as f:
+                f.write("\n".join(lines) + "\n")
+    print(f"Profile ({mode}) hot spots written to:", top_file)
+
+# -------------------------
+# Helper utilities
+# -------------------------
+def safe_read_csv(path, encoding="utf-8", **kwargs):
+    """Read CSV robustly as strings (keeps header row intact). Extra pandas options such as
+       nrows or chunksize are passed through (chunksize returns an iterator of frames).
+       Whole-file reads of a path go through the parsed-CSV cache when CSV_CACHE_DIRNAME is set."""
+    import pandas as pd
+    if CSV_CACHE_DIRNAME and not kwargs and isinstance(path, (str, os.PathLike)):
+        return cached_read_csv(path, encoding)
+    return pd.read_csv(path, dtype=str, encoding=encoding, keep_default_na=False, **kwargs)
 
 # -------------------------
-# Load files
+# Parsed-CSV cache: a columnar copy of each raw CSV, reused until the source changes
 # -------------------------
-# The original used csv.reader -> list -> DataFrame where row 0 contains column names.
-# Here we read normally with pandas; keep empty strings instead of NaN for fidelity.
-mbi = safe_read_csv(mbi_file, encoding='utf-8-sig')       # REDCap export (rows per event)
-outcome = safe_read_csv(outcome_file)                    # single-column list of ids
-partner = safe_read_csv(partner_file, encoding='utf-8')  # PartnerReport
+CSV_CACHE_STATS = {'hits': 0, 'misses': 0}
+
+def file_sha256(path, block_size=1 << 20):
+    """sha256 of a whole file, read in blocks."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def feather_available():
+    """Feather (Arrow IPC, memory-mapped on load) needs pyarrow; otherwise the cache uses pickle."""
+    try:
+        import pyarrow.feather  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+def cached_read_csv(path, encoding="utf-8"):
+    """safe_read_csv through the cache in <csv folder>/CSV_CACHE_DIRNAME. An entry is keyed by the
+       absolute path, encoding and format and validated against size + mtime; when only the mtime moved, the
+       content sha256 decides. Any other change re-parses the CSV and rewrites the entry."""
+    import pandas as pd
+    source = os.path.abspath(path)
+    stat = os.stat(source)
+    cache_dir = os.path.join(os.path.dirname(source), CSV_CACHE_DIRNAME)
+    use_feather = feather_available()
+    fmt = "feather" if use_feather else "pkl"
+    key = hashlib.sha1(f"{source}|{encoding}|{fmt}".encode('utf-8')).hexdigest()[:16]
+    data_file = os.path.join(cache_dir, f"{os.path.basename(source)}.{key}.{fmt}")
+    meta_file = os.path.join(cache_dir, f"{os.path.basename(source)}.{key}.json")
+
+    meta = None
+    if os.path.exists(data_file) and os.path.exists(meta_file):
+        with open(meta_file) as f:
+            meta = json.load(f)
+    valid = meta is not None and meta['size'] == stat.st_size
+    if valid and meta['mtime_ns'] != stat.st_mtime_ns:
+        # touched but maybe not modified: compare content
+        valid = meta['sha256'] == file_sha256(source)
+        if valid:
+            meta['mtime_ns'] = stat.st_mtime_ns
+            with open(meta_file, 'w') as f:
+                json.dump(meta, f, indent=2)
+
+    if valid:
+        with STATS_LOCK:
+            CSV_CACHE_STATS['hits'] += 1
+        if use_feather:
+            import pyarrow.feather
+            return pyarrow.feather.read_table(data_file, memory_map=True).to_pandas()
+        return pd.read_pickle(data_file)
 
-# ensure columns exist (avoid KeyError later)
-mbi.columns = mbi.columns.astype(str)
-partner.columns = partner.columns.astype(str)
+    with STATS_LOCK:
+        CSV_CACHE_STATS['misses'] += 1
+    df = pd.read_csv(source, dtype=str, encoding=encoding, keep_default_na=False)
+    os.makedirs(cache_dir, exist_ok=True)
+    if use_feather:
+        import pyarrow.feather
+        pyarrow.feather.write_feather(df, data_file)
+    else:
+        df.to_pickle(data_file)
+    with open(meta_file, 'w') as f:
+        json.dump({'source': source, 'encoding': encoding, 'size': stat.st_size,
+                   'mtime_ns': stat.st_mtime_ns, 'sha256': file_sha256(source)}, f, indent=2)
+    return df
 
-# Extract sid list from outcome file (first column)
-sid = outcome.iloc[:, 0].astype(str).tolist()
+def parse_snapshot_column(values):
+    """Parse an ISO-8601 snapshot column (any UTC offset, e.g. '2024-01-01T12:00:00-04:00') into
+       timezone-aware UTC timestamps. Blank or invalid cells become NaT."""
+    import pandas as pd
+    return pd.to_datetime(values.astype(str).str.strip(), utc=True, format="ISO8601", errors="coerce")
 
 # -------------------------
 # Provide MBI helper functions that mirror original gatherdata behaviour
 # -------------------------
-def gathersid(arg):
+def gathersid(mbi, arg, sid):
     """Return MPP2_data list (for ids in outcome list) and the column index of arg in mbi."""
     # find column index where header equals arg (original used MPP2_df.loc[0,i] == arg)
     if arg not in mbi.columns:
         raise KeyError(f"{arg} not found in MBIProjectPhase2 columns")
     arg_ind = mbi.columns.get_loc(arg)
-    MPP2_data = []
-    # For each row in mbi, if record_id in sid_list then append the value at arg_ind
-    for _, row in mbi.iterrows():
-        rec = str(row.get('record_id', ''))
-        # check membership in sid list (original used substring 'in')
-        for s in sid:
-            if rec == str(s):
-                MPP2_data.append(row.iloc[arg_ind])
-                break
+    # rows whose record_id is in the sid list, in file order
+    MPP2_data = mbi.loc[mbi['record_id'].astype(str).isin(sid), arg].tolist()
     return MPP2_data, arg_ind
 
-def gatherevent(arg):
+def gatherevent(mbi, arg):
     """Return column index of redcap_event_name variable (mirrors original function)."""
     if arg not in mbi.columns:
         raise KeyError(f"{arg} not found in MBIProjectPhase2 columns")
     return mbi.columns.get_loc(arg)
 
-def gatherdata(var_name, redcap_event_name):
+def build_event_index(mbi_df):
+    """Map (record_id, redcap_event_name) to the row position of its first match in mbi_df.
+       Built once so every variable lookup is a hash probe instead of a scan of the export."""
+    import numpy as np
+    import pandas as pd
+    keys = pd.MultiIndex.from_arrays([mbi_df['record_id'].astype(str), mbi_df['redcap_event_name'].astype(str)])
+    # first occurrence wins, as in the original row scan
+    first = ~keys.duplicated(keep='first')
+    return pd.Series(np.flatnonzero(first), index=keys[first])
+
+def gatherdata_batch(mbi, mbi_event_index, var_names, redcap_event_name, sid_list):
+    """Return {var_name: list of values for each sid} at redcap_event_name, using mbi_event_index.
+       Missing rows, blank cells and variables absent from the export give None (as gatherdata did)."""
+    import numpy as np
+    import pandas as pd
+    lookup = pd.MultiIndex.from_arrays([[str(s) for s in sid_list], [redcap_event_name] * len(sid_list)])
+    rows = mbi_event_index.reindex(lookup).to_numpy()
+    found = ~pd.isna(rows)
+    positions = rows[found].astype('int64')
+    results = {}
+    for var_name in var_names:
+        if var_name not in mbi.columns:
+            results[var_name] = [None] * len(sid_list)
+            continue
+        values = np.full(len(sid_list), None, dtype=object)
+        values[found] = mbi[var_name].to_numpy(dtype=object)[positions]
+        results[var_name] = [v if v != "" else None for v in values]
+    return results
+
+def gatherdata(mbi, mbi_event_index, var_name, redcap_event_name, sid_list):
     """Return list of variable values for each sid, matching record_id & redcap_event_name."""
-    # find var column index if exists
-    if var_name in mbi.columns:
-        var_ind = mbi.columns.get_loc(var_name)
+    return gatherdata_batch(mbi, mbi_event_index, [var_name], redcap_event_name, sid_list)[var_name]
+
+# -------------------------
+# Load REDCap inputs (mirror original flow)
+# -------------------------
+def input_problems(expected):
+    """Cheap checks of raw CSVs before anything is parsed (no pandas): every (path, required columns,
+       encoding, case-insensitive match) must exist, its header line and the next INPUT_PROBE_BYTES must
+       decode, and the header must hold the required columns. Returns a list of problems (empty if OK)."""
+    problems = []
+    for path, columns, encoding, ignore_case in expected:
+        if not os.path.isfile(path):
+            problems.append(f"missing file: {path}")
+            continue
+        try:
+            with open(path, 'rb') as f:
+                first_line = f.readline()
+                probe = f.read(INPUT_PROBE_BYTES)
+            decoder = codecs.getincrementaldecoder(encoding)()
+            header_line = decoder.decode(first_line)
+            decoder.decode(probe)  # not final: a character cut at the end of the probe is fine
+        except UnicodeDecodeError as e:
+            problems.append(f"{path}: not readable as {encoding} ({e})")
+            continue
+        header = next(csv.reader([header_line]), None)
+        if not header:
+            problems.append(f"{path}: no header row")
+            continue
+        present = {h.lower() for h in header} if ignore_case else set(header)
+        missing = [c for c in columns if (c.lower() if ignore_case else c) not in present]
+        if missing:
+            problems.append(f"{path}: missing column(s) {', '.join(missing)}")
+    return problems
+
+def expected_inputs(mbi, outcome, partner=None):
+    """The input_problems() checks for the inputs given as paths (DataFrames and None are skipped)."""
+    # (file, required columns, encoding, case-insensitive match as in index_inputs)
+    expected = [
+        (mbi, ['record_id', 'redcap_event_name'], 'utf-8-sig', True),
+        (outcome, [], 'utf-8', False),
+        (partner, ['sid', 'session_start_date', 'session_duration'], 'utf-8', False),
+    ]
+    return [check for check in expected if isinstance(check[0], (str, os.PathLike))]
+
+def check_inputs(mbi, outcome, partner=None):
+    """Raise before any parsing if an input given as a path is missing (FileNotFoundError), cannot be
+       decoded or lacks a required column (ValueError)."""
+    expected = expected_inputs(mbi, outcome, partner)
+    problems = input_problems(expected)
+    if problems:
+        missing = any(not os.path.isfile(path) for path, *_ in expected)
+        raise (FileNotFoundError if missing else ValueError)("input problems:\n  " + "\n  ".join(problems))
+
+class SerialExecutor(concurrent.futures.Executor):
+    """Executor that runs each task in the calling thread when it is submitted."""
+
+    def submit(self, fn, /, *args, **kwargs):
+        future = concurrent.futures.Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+        return future
+
+def input_pool():
+    """Thread pool for reading the raw inputs concurrently (INPUT_THREADS threads). With one thread, or
+       when PROFILE_MODE is set (cProfile only sees the thread that enabled it), the reads run one after
+       another in the calling thread instead."""
+    if PROFILE_MODE or (INPUT_THREADS or 1) <= 1:
+        return SerialExecutor()
+    return concurrent.futures.ThreadPoolExecutor(max_workers=INPUT_THREADS, thread_name_prefix='read_input')
+
+def read_redcap(mbi):
+    """The REDCap export (rows per event): a path, or a DataFrame with string cells (blanks as "")."""
+    import pandas as pd
+    # The original used csv.reader -> list -> DataFrame where row 0 contains column names.
+    # Here we read normally with pandas; keep empty strings instead of NaN for fidelity.
+    with stage('read_redcap') as info:
+        if isinstance(mbi, pd.DataFrame):
+            mbi = mbi.fillna("")
+        else:
+            mbi = safe_read_csv(mbi, encoding='utf-8-sig')
+        info['rows_out'] = len(mbi)
+    return mbi
+
+def read_outcome(outcome):
+    """The outcome list (single column of ids): a path or a DataFrame."""
+    import pandas as pd
+    with stage('read_outcome') as info:
+        if not isinstance(outcome, pd.DataFrame):
+            outcome = safe_read_csv(outcome)
+        info['rows_out'] = info['participants'] = len(outcome)
+    return outcome
+
+def outcome_sids(outcome):
+    """The sid list of the outcome frame (its first column, as strings)."""
+    return outcome.iloc[:, 0].astype(str).tolist()
+
+def load_inputs(mbi, outcome, partner=None):
+    """Load the adherence inputs; each is a CSV path or a DataFrame with string cells (as read with
+       dtype=str). Returns a dict with the REDCap frame 'mbi', the outcome id list 'sid', the
+       (record_id, event) index 'mbi_event_index' and 'partner' as given (its rows are folded
+       later by compute_metrics, so a path is never loaded whole here). Paths are checked up front
+       (check_inputs) and the REDCap export and outcome list are read concurrently."""
+    check_inputs(mbi, outcome, partner)
+    with input_pool() as pool:
+        mbi, outcome = pool.submit(read_redcap, mbi), pool.submit(read_outcome, outcome)
+        return index_inputs(mbi.result(), outcome.result(), partner)
+
+def index_inputs(mbi, outcome, partner=None):
+    """load_inputs() output from the REDCap and outcome frames as read by read_redcap/read_outcome."""
+    # ensure columns exist (avoid KeyError later)
+    mbi.columns = mbi.columns.astype(str)
+
+    # Extract sid list from outcome file (first column)
+    sid = outcome_sids(outcome)
+
+    # gather sids and record_id index (original usage)
+    # Note: original gathersid appended values for rows with record_id in sid_list; for compatibility, we call but mainly need the index.
+    try:
+        MPP2_sid, record_id_ind = gathersid(mbi, 'record_id', sid)
+    except KeyError:
+        # fallback: find 'record_id' case-insensitively
+        rec_cols = [c for c in mbi.columns if c.lower() == 'record_id']
+        if rec_cols:
+            mbi = mbi.rename(columns={rec_cols[0]: 'record_id'})
+            MPP2_sid, record_id_ind = gathersid(mbi, 'record_id', sid)
+        else:
+            raise
+
+    # gather index for redcap_event_name column
+    try:
+        redcap_event_name_ind = gatherevent(mbi, 'redcap_event_name')
+    except KeyError:
+        # fallback: attempt to find close match
+        rec_cols = [c for c in mbi.columns if c.lower() == 'redcap_event_name']
+        if rec_cols:
+            mbi = mbi.rename(columns={rec_cols[0]: 'redcap_event_name'})
+            redcap_event_name_ind = gatherevent(mbi, 'redcap_event_name')
+        else:
+            raise
+
+    # (record_id, redcap_event_name) -> row index, built once after the column names are settled
+    with stage('index_redcap', rows_in=len(mbi)):
+        mbi_event_index = build_event_index(mbi)
+    return {'mbi': mbi, 'sid': sid, 'mbi_event_index': mbi_event_index, 'partner': partner}
+
+# -------------------------
+# Partner preparation (applied to the whole file, or to each chunk when streaming)
+# -------------------------
+SENTINEL_START = datetime.date(9999, 1, 1)
+
+def parse_session_start(s):
+    """Parse a session_start_date cell like the original loops: '-' -> '/', then '%Y/%m/%d',
+       then a flexible pandas parse; None for blanks and unparseable values."""
+    import pandas as pd
+    start_norm = str(s).replace("-", "/")
+    if start_norm.strip() == "":
+        return None
+    try:
+        return datetime.datetime.strptime(start_norm, "%Y/%m/%d").date()
+    except Exception:
+        try:
+            parsed = pd.to_datetime(start_norm, errors='coerce')
+            if pd.isna(parsed):
+                return None
+            return parsed.date()
+        except Exception:
+            return None
+
+def normalize_session_dates(dates):
+    """Convert a raw session_start_date column to datetime64, parsing each distinct string once.
+       Blank/unparseable values become NaT (second resolution, so a literal '9999/01/01' still fits)."""
+    import numpy as np
+    import pandas as pd
+    codes, uniques = pd.factorize(dates.astype(str))
+    parsed = [parse_session_start(u) for u in uniques]
+    parsed = np.array(['NaT' if d is None else d.isoformat() for d in parsed], dtype='datetime64[s]')
+    return pd.Series(parsed[codes], index=dates.index, dtype='datetime64[s]')
+
+def int_cells(values, invalid=None):
+    """int() of every cell of a string column (the original per-cell int(str(val)) check) as the
+       smallest nullable integer array (Int8..Int64) holding the values. Cells int() rejects
+       become invalid (<NA> when None)."""
+    import numpy as np
+    import pandas as pd
+    values = values.astype(str)
+    # plain digit strings (nearly every cell) convert in one vectorized pass; the rest (signs, spaces,
+    # underscores, invalid text, ...) go through int() once per distinct value
+    plain = values.str.fullmatch(r'[0-9]{1,18}').to_numpy(dtype=bool)
+    rest = ~plain
+    codes, uniques = pd.factorize(values[rest])
+    parsed = []
+    for u in uniques:
+        try:
+            parsed.append(int(u))
+        except ValueError:
+            parsed.append(invalid)
+    ok = np.array([v is not None for v in parsed], dtype=bool)
+    table = [v if v is not None else 0 for v in parsed]
+    # beyond int64 the values stay floats (as to_numeric would give)
+    fits = all(-2**63 <= v < 2**63 for v in table)
+    data = np.zeros(len(values), dtype='int64' if fits else 'float64')
+    data[plain] = values[plain].astype('int64')
+    data[rest] = np.array(table, dtype=data.dtype)[codes]
+    mask = np.zeros(len(values), dtype=bool)
+    mask[rest] = ~ok[codes]
+    if not fits:
+        return pd.arrays.FloatingArray(data, mask)
+    valid = data[~mask]
+    lo, hi = (valid.min(), valid.max()) if len(valid) else (0, 0)
+    for dtype in ['int8', 'int16', 'int32']:
+        if np.iinfo(dtype).min <= lo and hi <= np.iinfo(dtype).max:
+            data = data.astype(dtype)
+            break
+    return pd.arrays.IntegerArray(data, mask)
+
+# Typed in-memory PartnerReport: column -> kind (columns not listed stay strings)
+#   category  repeated labels
+#   int0      int() or 0, as the original script coerced session_duration
+#   int       int() or <NA>;  float: to_numeric() or <NA> (Float32, vitals)
+PARTNER_SCHEMA = {
+    'sid': 'category', 'session_stage': 'category', 'group': 'category', 'session_type': 'category',
+    'session_number': 'int', 'session_duration': 'int0', 'session_length': 'int',
+    'heartrate_pre': 'float', 'breathrate_pre': 'float', 'o2level_pre': 'float',
+    'hrv_low_freq_sum_pre': 'float', 'hrv_high_freq_sum_pre': 'float',
+    'heartrate_post': 'float', 'breathrate_post': 'float', 'o2level_post': 'float',
+    'hrv_low_freq_sum_post': 'float', 'hrv_high_freq_sum_post': 'float',
+}
+
+def typed_column(values, kind):
+    """Convert a string column to its PARTNER_SCHEMA kind."""
+    import pandas as pd
+    if kind == 'category':
+        return values.astype('category')
+    if kind == 'int0':
+        return int_cells(values, invalid=0)
+    if kind == 'int':
+        return int_cells(values)
+    return pd.to_numeric(values, errors='coerce').astype('Float32')
+
+def prepare_partner(partner_df):
+    """Convert a PartnerReport frame of strings to the compact typed representation: PARTNER_SCHEMA
+       categoricals and masked numbers (session_duration invalid -> 0, vitals invalid -> <NA>), datetime64
+       session_start_date (NaT when blank/unparseable) and tz-aware snapshot columns."""
+    import pandas as pd
+    partner_df = partner_df.fillna("")
+    n_rows = len(partner_df)
+    with stage('normalize_dates', rows_in=n_rows) as info:
+        partner_df['session_start_date'] = normalize_session_dates(partner_df['session_start_date'])
+        info['rows_out'] = n_rows
+    with stage('typed_columns', rows_in=n_rows) as info:
+        for name, kind in PARTNER_SCHEMA.items():
+            if name in partner_df.columns:
+                partner_df[name] = typed_column(partner_df[name], kind)
+        info['rows_out'] = n_rows
+    # the four snapshot columns become tz-aware datetime columns once
+    with stage('clean_snapshots', rows_in=n_rows) as info:
+        for colname in ['snapshot_start_pre','snapshot_finish_pre','snapshot_start_post','snapshot_finish_post']:
+            if colname in partner_df.columns:
+                partner_df[colname] = parse_snapshot_column(partner_df[colname])
+            else:
+                # missing column behaves like an all-'null' column in the original
+                partner_df[colname] = pd.Series(pd.NaT, index=partner_df.index, dtype="datetime64[ns, UTC]")
+        info['rows_out'] = n_rows
+    return partner_df
+
+# -------------------------
+# compute_delta_snap function (column arithmetic on the parsed snapshots)
+# -------------------------
+def compute_delta_snap(partner_df, snapshot_start_col, snapshot_finish_col, legacy_seconds=None):
+    """Return the snapshot delta (whole seconds) of every row; the sid/window filtering the original
+       repeated per participant is done once by the aggregation engine.
+       A missing/invalid timestamp on either side gives 0. With legacy_seconds the delta wraps into
+       [0, 86400) like the original timedelta.seconds; otherwise it is the true elapsed time (negatives -> 0)."""
+    import numpy as np
+    if legacy_seconds is None:
+        legacy_seconds = SNAPSHOT_LEGACY_SECONDS
+    elapsed = (partner_df[snapshot_finish_col] - partner_df[snapshot_start_col]).dt.total_seconds()
+    elapsed = np.floor(elapsed)
+    if legacy_seconds:
+        elapsed = elapsed % 86400
     else:
-        var_ind = None
-
-    # if var doesn't exist, return list of None
-    if var_ind is None:
-        return [None] * len(sid)
-
-    results = []
-    # For each id in sid, find row where record_id==sid and redcap_event_name==redcap_event_name
-    for s in sid:
-        found = None
-        for _, row in mbi.iterrows():
-            if str(row.get('record_id', '')) == str(s) and str(row.get('redcap_event_name', '')) == redcap_event_name:
-                found = row.iloc[var_ind]
-                break
-        # append found or None
-        results.append(found if found != "" else None)
-    return results
+        elapsed = elapsed.clip(lower=0)
+    return elapsed.fillna(0).astype('int64')
 
 # -------------------------
-# Run prerequisites (mirror original flow)
+# Aggregation engine: session rows -> per-(sid, day) partial sums -> per-sid totals
 # -------------------------
-# gather sids and record_id index (original usage)
-# Note: original gathersid appended values for rows with record_id in sid_list; for compatibility, we call but mainly need the index.
-try:
-    MPP2_sid, record_id_ind = gathersid('record_id')
-except KeyError:
-    # fallback: find 'record_id' case-insensitively
-    rec_cols = [c for c in mbi.columns if c.lower() == 'record_id']
-    if rec_cols:
-        mbi = mbi.rename(columns={rec_cols[0]: 'record_id'})
-        MPP2_sid, record_id_ind = gathersid('record_id')
+# Every per-sid metric is a sum or max over sessions, and the adherence windows only depend on the
+# session day, so sessions can be folded into one row per (sid, session_start_date) first. That fold
+# is associative, which is what lets PartnerReport be streamed in chunks with bounded memory.
+# physiological measures recorded before (_pre) and after (_post) each session
+VITAL_NAMES = ['heartrate', 'breathrate', 'o2level', 'hrv_low_freq_sum', 'hrv_high_freq_sum']
+# per vital: sums and counts of the valid pre/post values, and of post - pre where both are valid
+VITAL_SUM_COLUMNS = [f'{vital}_{part}_{agg}' for vital in VITAL_NAMES
+                     for part in ['pre', 'post', 'delta'] for agg in ['sum', 'n']]
+DAY_SUM_COLUMNS = ['session_duration', 'delta_snap_pre', 'delta_snap_post',
+                   'sessiontype_journey_totalcount', 'sessiontype_standalonesnap_totalcount'] + VITAL_SUM_COLUMNS
+
+def session_row_metrics(partner_df, duration_cap=None, vitals=True):
+    """Return the per-session values the aggregates are built from (sid, session_start_date, capped
+       session_duration, snapshot deltas, session type flags, session_stage and, with vitals, the
+       vital sums) for a prepared frame. Durations are capped at duration_cap (default DURATION_CAP).
+       Sessions without a valid start date sit on the '9999/01/01' sentinel day with no duration, as the
+       original left them out of every duration sum but still counted their snapshots."""
+    import pandas as pd
+    def column_or_blank(name):
+        if name in partner_df.columns:
+            return partner_df[name].astype(str)
+        return pd.Series("", index=partner_df.index)
+
+    n_rows = len(partner_df)
+    with stage('delta_snap', rows_in=n_rows) as info:
+        delta_snap_pre = compute_delta_snap(partner_df, 'snapshot_start_pre', 'snapshot_finish_pre')
+        delta_snap_post = compute_delta_snap(partner_df, 'snapshot_start_post', 'snapshot_finish_post')
+        info['rows_out'] = n_rows
+    with stage('session_metrics', rows_in=n_rows) as info:
+        # session_duration is an integer column (invalid -> 0) after prepare_partner; cap at 3600s
+        duration = pd.to_numeric(partner_df['session_duration'], errors='coerce').fillna(0)
+        start = partner_df['session_start_date']
+        dated = start.notna()
+        duration = duration.where(dated, 0)
+        session_type = column_or_blank('session_type')
+        rows = pd.DataFrame({
+            'sid': partner_df['sid'].astype(str),
+            'session_start_date': start.fillna(pd.Timestamp(SENTINEL_START)),
+            'session_duration': duration.clip(upper=DURATION_CAP if duration_cap is None else duration_cap).astype('int64'),
+            'delta_snap_pre': delta_snap_pre,
+            'delta_snap_post': delta_snap_post,
+            'sessiontype_journey_totalcount': session_type.str.contains('Journey', regex=False).astype('int64'),
+            'sessiontype_standalonesnap_totalcount': session_type.str.contains('Standalone', regex=False).astype('int64'),
+            'session_stage': column_or_blank('session_stage'),
+        })
+        info['rows_out'] = n_rows
+    if not vitals:
+        return rows
+    with stage('vital_metrics', rows_in=n_rows) as info:
+        for col, values in vital_row_sums(partner_df).items():
+            rows[col] = values
+        info['rows_out'] = n_rows
+    return rows
+
+def vital_row_sums(partner_df):
+    """Per-session VITAL_SUM_COLUMNS: each valid pre/post value (and post - pre when both are valid)
+       with a count of 1, invalid/blank/missing values as 0 with a count of 0."""
+    import numpy as np
+    import pandas as pd
+    def values(name):
+        if name not in partner_df.columns:
+            return np.full(len(partner_df), np.nan)
+        return pd.to_numeric(partner_df[name], errors='coerce').to_numpy(dtype='float64', na_value=np.nan)
+
+    sums = {}
+    for vital in VITAL_NAMES:
+        pre, post = values(f'{vital}_pre'), values(f'{vital}_post')
+        for part, v in [('pre', pre), ('post', post), ('delta', post - pre)]:
+            valid = ~np.isnan(v)
+            sums[f'{vital}_{part}_sum'] = np.where(valid, v, 0.0)
+            sums[f'{vital}_{part}_n'] = valid.astype('int8')  # 0/1 per session; the fold sums into int64
+    return sums
+
+def fold_partner_days(frames, sid_list=None):
+    """Fold session rows and/or earlier folded states into one row per (sid, session_start_date)
+       holding the sums of DAY_SUM_COLUMNS and the max session_stage. Rows of sids outside
+       sid_list are dropped."""
+    import pandas as pd
+    rows = pd.concat(frames, ignore_index=True)
+    with stage('fold_days', rows_in=len(rows)) as info:
+        if sid_list is not None:
+            rows = rows[rows['sid'].isin(sid_list)]
+        # one vectorized sum over every DAY_SUM_COLUMNS column, then the max stage
+        grouped = rows.groupby(['sid', 'session_start_date'], sort=False)
+        days = grouped[DAY_SUM_COLUMNS].sum()
+        days['session_stage'] = grouped['session_stage'].max()
+        days = days.reset_index()
+        info['rows_out'] = len(days)
+        info['participants'] = days['sid'].nunique()
+    return days
+
+def bin_sessions(offset_days, window_edges=None):
+    """Return the window number (1..n) of every session from its day offset to the participant's
+       first session, in one searchsorted pass over the sorted edges; 0 = outside every window."""
+    import numpy as np
+    if window_edges is None:
+        window_edges = WINDOW_EDGES_DAYS
+    edges = np.asarray(window_edges)
+    pos = np.searchsorted(edges, np.asarray(offset_days), side='right')
+    return np.where(pos < len(edges), pos, 0)
+
+def finalize_partner_totals(days, sid_list, window_edges=None):
+    """Return a DataFrame indexed like sid_list with the per-participant partner metrics
+       (study-period duration sum, snapshot deltas, per-window durations sessionduration_wk1..n,
+       session type counts, max stage) from the folded per-(sid, day) state."""
+    import pandas as pd
+    if window_edges is None:
+        window_edges = WINDOW_EDGES_DAYS
+    with stage('weekly_windows', rows_in=len(days), participants=len(sid_list)) as info:
+        sid_col = days['sid']
+        start = days['session_start_date']
+        # days since the participant's earliest session
+        offset = (start - start.groupby(sid_col).transform('min')).dt.days
+        with_snaps = days['session_duration'] + days['delta_snap_pre'] + days['delta_snap_post']
+
+        in_study = offset < window_edges[-1]
+        per_day = pd.DataFrame({
+            'sid': sid_col,
+            'session_duration_sum': days['session_duration'].where(in_study, 0),
+            'delta_snap_pre': days['delta_snap_pre'].where(in_study, 0),
+            'delta_snap_post': days['delta_snap_post'].where(in_study, 0),
+            'sessiontype_journey_totalcount': days['sessiontype_journey_totalcount'],
+            'sessiontype_standalonesnap_totalcount': days['sessiontype_standalonesnap_totalcount'],
+            'session_stage_max': days['session_stage'],
+        })
+        vital_sums = days[VITAL_SUM_COLUMNS].mul(in_study.astype('int64'), axis=0)
+
+        grouped = per_day.groupby('sid', sort=False)
+        totals = grouped.sum(numeric_only=True)
+        totals['session_stage_max'] = grouped['session_stage_max'].max()
+
+        # per-window durations (snapshots included): one (sid, window) groupby whatever the number of windows
+        n_windows = len(window_edges) - 1
+        window = bin_sessions(offset, window_edges)
+        by_window = with_snaps.groupby([sid_col, window]).sum().unstack(fill_value=0)
+        by_window = by_window.reindex(index=totals.index, columns=range(1, n_windows + 1), fill_value=0)
+        by_window.columns = [f'sessionduration_wk{k}' for k in by_window.columns]
+        totals = totals.join(by_window)
+        vitals = vital_means(vital_sums.groupby(sid_col, sort=False).sum(), days, window, n_windows)
+
+        # sids without partner rows keep zero totals and a '0' stage, as the original loops did
+        totals = totals.reindex(pd.Index(sid_list, dtype=object))
+        counts = totals.columns.drop('session_stage_max')
+        totals[counts] = totals[counts].fillna(0).astype('int64')
+        totals = totals.join(vitals)
+        has_sessions = totals['session_stage_max'].notna()
+        max_stage = totals['session_stage_max'].astype(object)
+        totals['adherence_stage'] = ['1' if ok and st > 'S20' else '0' for ok, st in zip(has_sessions, max_stage)]
+        totals['session_stage_max'] = [st if ok else '0' for ok, st in zip(has_sessions, max_stage)]
+        info['rows_out'] = len(totals)
+    return totals
+
+def vital_means(study_sums, days, window, n_windows):
+    """Per-sid vital summaries from the folded sums: study-period means of the pre and post values
+       and of post - pre ({vital}_pre_mean, _post_mean, _delta_mean), and the mean post - pre per
+       adherence window ({vital}_delta_wk1..n). NaN where a participant has no valid value."""
+    import pandas as pd
+    means = {}
+    for vital in VITAL_NAMES:
+        for part in ['pre', 'post', 'delta']:
+            n = study_sums[f'{vital}_{part}_n']
+            means[f'{vital}_{part}_mean'] = (study_sums[f'{vital}_{part}_sum'] / n.where(n > 0)).round(3)
+    result = pd.DataFrame(means, index=study_sums.index)
+    # per-window delta means: one (sid, window) groupby for every vital at once
+    delta_columns = [f'{vital}_delta_{agg}' for vital in VITAL_NAMES for agg in ['sum', 'n']]
+    by_window = days[delta_columns].groupby([days['sid'], window]).sum()
+    for vital in VITAL_NAMES:
+        n = by_window[f'{vital}_delta_n']
+        mean = (by_window[f'{vital}_delta_sum'] / n.where(n > 0)).round(3).unstack()
+        mean = mean.reindex(index=result.index, columns=range(1, n_windows + 1))
+        for k in range(1, n_windows + 1):
+            result[f'{vital}_delta_wk{k}'] = mean[k]
+    return result
+
+def aggregate_partner_sessions(partner_df, sid_list, window_edges=None):
+    """In-memory path: per-participant partner metrics of a prepared PartnerReport frame."""
+    days = fold_partner_days([session_row_metrics(partner_df)], sid_list)
+    return finalize_partner_totals(days, sid_list, window_edges)
+
+def stream_partner_days(source, sid_list, chunksize=None, encoding="utf-8", first_row=1):
+    """Read PartnerReport (a path or file-like object) and fold it into the per-(sid, day) state.
+       With chunksize, rows are read chunksize at a time so memory follows participant-days rather
+       than file size. With COERCION_REPORT the conversions are tallied into COERCION_SUMMARY on the
+       way (first_row: data row number of the first row read). Returns (days, number of rows read)."""
+    if chunksize:
+        chunks = safe_read_csv(source, encoding=encoding, chunksize=chunksize)
+    else:
+        with stage('read_partner') as info:
+            chunks = [safe_read_csv(source, encoding=encoding)]
+            info['rows_out'] = len(chunks[0])
+    days, n_rows = None, 0
+    for chunk in timed_reads(chunks, 'read_partner' if chunksize else None):
+        prepared = prepare_partner(chunk)
+        if COERCION_REPORT:
+            # prepare_partner converts a copy, so the raw cells are still there
+            partner_coercion(chunk.fillna(""), prepared, COERCION_SUMMARY, first_row + n_rows)
+        n_rows += len(chunk)
+        rows = session_row_metrics(prepared)
+        days = fold_partner_days([rows] if days is None else [days, rows], sid_list)
+    return days, n_rows
+
+def timed_reads(chunks, name):
+    """Yield the frames of chunks, timing each read (the reader parses lazily) as stage name."""
+    chunks = iter(chunks)
+    while True:
+        with stage(name) if name else contextlib.nullcontext({}) as info:
+            chunk = next(chunks, None)
+            info['rows_out'] = 0 if chunk is None else len(chunk)
+            info['calls'] = 0 if chunk is None else 1
+        if chunk is None:
+            return
+        yield chunk
+
+# -------------------------
+# Incremental runs: persisted per-(sid, day) state + watermark of the PartnerReport bytes folded so far
+# -------------------------
+def file_prefix_sha256(path, n_bytes, block_size=1 << 20):
+    """sha256 of the first n_bytes of a file, read in blocks."""
+    digest = hashlib.sha256()
+    remaining = n_bytes
+    with open(path, 'rb') as f:
+        while remaining > 0:
+            block = f.read(min(block_size, remaining))
+            if not block:
+                break
+            digest.update(block)
+            remaining -= len(block)
+    return digest.hexdigest()
+
+def state_fingerprint(sid_list):
+    """Everything besides the PartnerReport rows that the folded state depends on."""
+    # undated_duration: states folded before undated sessions were kept out of the duration sums differ
+    settings = {'sids': list(sid_list), 'columns': DAY_SUM_COLUMNS, 'duration_cap': DURATION_CAP,
+                'legacy_seconds': SNAPSHOT_LEGACY_SECONDS, 'undated_duration': 0}
+    return hashlib.sha256(json.dumps(settings).encode('utf-8')).hexdigest()
+
+def update_partner_state(path, sid_list, state_dir, chunksize=None, encoding="utf-8"):
+    """Return (days, changed_sids) for PartnerReport, folding only the rows appended since the last run.
+       The previous state is reused when the bytes it was built from are unchanged (same size prefix and
+       sha256, ending on a complete line) and the outcome list and settings match; changed_sids then
+       lists the sids of the appended rows. Otherwise the state is rebuilt and changed_sids is None.
+       With COERCION_REPORT the tallies of the folded rows are kept in the state as well."""
+    import pandas as pd
+    days_file = os.path.join(state_dir, "partner_days.pkl")
+    watermark_file = os.path.join(state_dir, "watermark.json")
+    coercion_file = os.path.join(state_dir, "coercion_summary.json")
+    fingerprint = state_fingerprint(sid_list)
+    size = os.path.getsize(path)
+
+    watermark = None
+    if os.path.exists(days_file) and os.path.exists(watermark_file):
+        with open(watermark_file) as f:
+            watermark = json.load(f)
+    reusable = (watermark is not None
+                and watermark.get('fingerprint') == fingerprint
+                and watermark.get('complete_line', False)
+                and size >= watermark['n_bytes']
+                and file_prefix_sha256(path, watermark['n_bytes']) == watermark['sha256']
+                and (not COERCION_REPORT or os.path.exists(coercion_file)))
+
+    if reusable:
+        if COERCION_REPORT:
+            with open(coercion_file) as f:
+                merge_coercion(COERCION_SUMMARY, {(e['file'], e['column']): e for e in json.load(f)})
+        with open(path, 'rb') as f:
+            header = f.readline()
+            f.seek(watermark['n_bytes'])
+            appended = f.read()
+        new_days, n_new = stream_partner_days(io.BytesIO(header + appended), sid_list, chunksize, encoding,
+                                              first_row=watermark['n_rows'] + 1)
+        days = fold_partner_days([pd.read_pickle(days_file), new_days], sid_list)
+        changed_sids = new_days['sid'].unique().tolist()
+        n_rows = watermark['n_rows'] + n_new
+        print(f"Incremental run: {n_new} new PartnerReport rows, {len(changed_sids)} participants updated")
     else:
-        raise
-
-# gather index for redcap_event_name column
-try:
-    redcap_event_name_ind = gatherevent('redcap_event_name')
-except KeyError:
-    # fallback: attempt to find close match
-    rec_cols = [c for c in mbi.columns if c.lower() == 'redcap_event_name']
-    if rec_cols:
-        mbi = mbi.rename(columns={rec_cols[0]: 'redcap_event_name'})
-        redcap_event_name_ind = gatherevent('redcap_event_name')
+        if watermark is not None:
+            print("PartnerReport changed before the last watermark (or settings changed); rebuilding state")
+        days, n_rows = stream_partner_days(path, sid_list, chunksize, encoding)
+        changed_sids = None
+
+    os.makedirs(state_dir, exist_ok=True)
+    days.to_pickle(days_file)
+    with open(path, 'rb') as f:
+        f.seek(max(size - 1, 0))
+        complete_line = size == 0 or f.read(1) in (b"\n", b"\r")
+    max_start = days['session_start_date'].max() if len(days) else None
+    with open(watermark_file, 'w') as f:
+        json.dump({'n_bytes': size, 'sha256': file_prefix_sha256(path, size), 'complete_line': complete_line,
+                   'n_rows': n_rows, 'max_session_start_date': None if pd.isna(max_start) else str(max_start),
+                   'fingerprint': fingerprint}, f, indent=2)
+    if COERCION_REPORT:
+        with open(coercion_file, 'w') as f:
+            json.dump(list(COERCION_SUMMARY.values()), f, indent=2)
+    elif os.path.exists(coercion_file):
+        # it no longer covers every folded row
+        os.remove(coercion_file)
+    return days, changed_sids
+
+def refresh_partner_totals(days, sid_list, changed_sids, state_dir, window_edges=None):
+    """Per-sid totals for an incremental run: only changed_sids are recomputed from the folded state,
+       the others come from the totals persisted by the previous run (same windows required)."""
+    import pandas as pd
+    if window_edges is None:
+        window_edges = WINDOW_EDGES_DAYS
+    totals_file = os.path.join(state_dir, "partner_totals.pkl")
+    edges_file = os.path.join(state_dir, "window_edges.json")
+    previous = None
+    if changed_sids is not None and os.path.exists(totals_file) and os.path.exists(edges_file):
+        with open(edges_file) as f:
+            if json.load(f) == list(window_edges):
+                previous = pd.read_pickle(totals_file)
+    if previous is None:
+        totals = finalize_partner_totals(days, sid_list, window_edges)
     else:
-        raise
-
-# -------------------------
-# Variables of interest (mirror original calls)
-# -------------------------
-randomization = gatherdata('randomization', 'day_1_arm_1')       # randomization at day_1
-mri_comp_2 = gatherdata('mri_comp_2', 'day_1_arm_1')            # MRI2 at day_1 (original variable name)
-week4_comp = gatherdata('week_4_8_questionnaires_complete', 'week_4_arm_1')
-debfried_comp = gatherdata('week_4_debriefing_complete', 'week_4_arm_1')  # preserved original typo name
-
-# -------------------------
-# Find indices in partner (adhere_df) matching original loop
-# -------------------------
-# original script assumes header row at row 0 and uses .loc[0,i] to find column names; here we get indices mapping by name
-col_index = {name: idx for idx, name in enumerate(partner.columns)}
-# define expected columns and set index variables if present (mirror original variable names)
-sid_index = col_index.get('sid', None)
-session_stage_index = col_index.get('session_stage', None)
-session_num_index = col_index.get('session_number', None)
-session_start_index = col_index.get('session_start_date', None)
-session_duration_index = col_index.get('session_duration', None)
-session_length_index = col_index.get('session_length', None)
-snapshot_start_pre_index = col_index.get('snapshot_start_pre', None)
-snapshot_finish_pre_index = col_index.get('snapshot_finish_pre', None)
-snapshot_start_post_index = col_index.get('snapshot_start_post', None)
-snapshot_finish_post_index = col_index.get('snapshot_finish_post', None)
-group_index = col_index.get('group', None)
-heartrate_pre_index = col_index.get('heartrate_pre', None)
-sessiontype_index = col_index.get('session_type', None)
-breathrate_pre_index = col_index.get('breathrate_pre', None)
-o2level_pre_indexx = col_index.get('o2level_pre', None)
-hrv_low_freq_sum_pre_index = col_index.get('hrv_low_freq_sum_pre', None)
-hrv_high_freq_sum_pre_index = col_index.get('hrv_high_freq_sum_pre', None)
-heartrate_post_index = col_index.get('heartrate_post', None)
-breathrate_post_index = col_index.get('breathrate_post', None)
-o2level_post_index = col_index.get('o2level_post', None)
-hrv_low_freq_sum_post_index = col_index.get('hrv_low_freq_sum_post', None)
-hrv_high_freq_sum_post_index = col_index.get('hrv_high_freq_sum_post', None)
-
-# -------------------------
-# Normalize session_start_date format and compute earliest session start per participant
-# -------------------------
-# Replace '-' with '/' and coerce blanks to '9999/01/01' as original did (we keep same sentinel)
-partner = partner.fillna("")
-# ensure session_start_date column exists
-if session_start_index is None:
-    raise KeyError("session_start_date column not found in PartnerReport.csv")
-
-# Normalize dates (string) and build earliest date per sid
-# We'll store parsed datetime.date objects (or sentinel) in dicts for efficient lookups
-earliest_start = {}
-# iterate partner rows (original used index base 0 and started at row 1; here header is column names)
-for _, row in partner.iterrows():
-    sid_val = str(row['sid'])
-    start_raw = str(row['session_start_date'])
-    start_norm = start_raw.replace("-", "/") if start_raw != "" else ""
-    if start_norm == "" or start_norm.strip() == "":
-        # original set to sentinel '9999/01/01'
-        parsed = datetime.datetime.strptime("9999/01/01", "%Y/%m/%d").date()
+        changed = pd.Index(changed_sids, dtype=object).unique()
+        updated = finalize_partner_totals(days[days['sid'].isin(changed)], changed, window_edges)
+        kept = previous[~previous.index.isin(changed)]
+        totals = pd.concat([kept[~kept.index.duplicated()], updated])
+        totals = totals.reindex(pd.Index(sid_list, dtype=object))
+    totals.to_pickle(totals_file)
+    with open(edges_file, 'w') as f:
+        json.dump(list(window_edges), f)
+    return totals
+
+def compute_partner_totals(partner_file, sid_list, state_dir=None, chunksize=None, window_edges=None):
+    """Per-sid partner totals of one PartnerReport (a path, or a DataFrame with string cells),
+       incrementally when state_dir is given."""
+    import pandas as pd
+    if isinstance(partner_file, pd.DataFrame):
+        if 'session_start_date' not in partner_file.columns:
+            raise KeyError("session_start_date column not found in PartnerReport")
+        raw = partner_file.fillna("").astype(str)
+        partner = prepare_partner(raw)
+        if COERCION_REPORT:
+            partner_coercion(raw, partner, COERCION_SUMMARY)
+        return aggregate_partner_sessions(partner, sid_list, window_edges)
+    # ensure session_start_date column exists (header only; rows are folded by the aggregation engine)
+    partner = safe_read_csv(partner_file, encoding='utf-8', nrows=0)
+    if 'session_start_date' not in partner.columns.astype(str):
+        raise KeyError("session_start_date column not found in PartnerReport.csv")
+    if state_dir:
+        partner_days, changed_sids = update_partner_state(partner_file, sid_list, state_dir, chunksize)
+        return refresh_partner_totals(partner_days, sid_list, changed_sids, state_dir, window_edges)
+    partner_days, _ = stream_partner_days(partner_file, sid_list, chunksize)
+    return finalize_partner_totals(partner_days, sid_list, window_edges)
+
+# -------------------------
+# Parallel folding of one large PartnerReport (row ranges in worker processes)
+# -------------------------
+def partner_byte_ranges(partner_file, n_shards):
+    """Split PartnerReport after its header into at most n_shards byte ranges that start on line
+       boundaries (cells must not contain line breaks). Returns (header bytes, [(start, end), ...])."""
+    size = os.path.getsize(partner_file)
+    with open(partner_file, 'rb') as f:
+        header = f.readline()
+        first = f.tell()
+        bounds = [first]
+        for k in range(1, n_shards):
+            f.seek(max(first + (size - first) * k // n_shards, bounds[-1]))
+            f.readline()  # move on to the start of the next line
+            bounds.append(min(f.tell(), size))
+    bounds.append(size)
+    ranges = [(lo, hi) for lo, hi in zip(bounds[:-1], bounds[1:]) if hi > lo]
+    return header, ranges
+
+def fold_partner_range(partner_file, header, start, end, sid_list, chunksize=None):
+    """Worker: fold the PartnerReport rows in bytes [start, end) into per-(sid, day) state.
+       Returns (days, the worker's stage stats and coercion tallies for this range, rows read)."""
+    STAGE_STATS.clear()
+    COERCION_SUMMARY.clear()
+    with open(partner_file, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    days, n_rows = stream_partner_days(io.BytesIO(header + data), sid_list, chunksize)
+    return days, dict(STAGE_STATS), dict(COERCION_SUMMARY), n_rows
+
+def compute_partner_totals_parallel(partner_file, sid_list, n_shards, max_workers=None, chunksize=None,
+                                    window_edges=None):
+    """Per-sid partner totals with PartnerReport split into n_shards row ranges folded in parallel.
+       The partial states are merged by sid with the same fold, so the result matches the serial path."""
+    from concurrent.futures import ProcessPoolExecutor
+    if not isinstance(partner_file, (str, os.PathLike)):
+        return compute_partner_totals(partner_file, sid_list, chunksize=chunksize, window_edges=window_edges)
+    header, ranges = partner_byte_ranges(partner_file, n_shards)
+    if not ranges:
+        return compute_partner_totals(partner_file, sid_list, chunksize=chunksize, window_edges=window_edges)
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=apply_settings, initargs=(current_settings(),)) as pool:
+        futures = [pool.submit(fold_partner_range, partner_file, header, lo, hi, sid_list, chunksize)
+                   for lo, hi in ranges]
+        partial = [future.result() for future in futures]
+    rows_before = 0
+    for _, stats, summary, n_rows in partial:
+        merge_stage_stats(stats)
+        # each range numbers its rows from 1
+        merge_coercion(COERCION_SUMMARY, summary, rows_before)
+        rows_before += n_rows
+    partial_days = [days for days, _, _, _ in partial]
+    return finalize_partner_totals(fold_partner_days(partial_days, sid_list), sid_list, window_edges)
+
+def fold_partner_totals(partner, sid_list, window_edges=None, state_dir=None, chunksize=None, shards=None,
+                        max_workers=None):
+    """Per-sid partner totals: sharded over worker processes when shards is set, otherwise serial
+       (incremental when state_dir is given)."""
+    if shards:
+        return compute_partner_totals_parallel(partner, sid_list, shards, max_workers, chunksize, window_edges)
+    return compute_partner_totals(partner, sid_list, state_dir, chunksize, window_edges)
+
+# -------------------------
+# Per-participant metrics (one row per sid, in outcome-list order)
+# -------------------------
+def completed_windows(window_durations, randomization_list):
+    """Return '1'/'0' flags (group_adherence_wk1..n) for every sid and window: MBI ('0') above
+       avg_weekly, control ('1') above avg_weekly_con, anything else '0'."""
+    import numpy as np
+    import pandas as pd
+    thresholds = np.array([avg_weekly if r == '0' else avg_weekly_con if r == '1' else np.inf
+                           for r in randomization_list])
+    flags = np.where(window_durations.to_numpy() > thresholds[:, None], '1', '0')
+    columns = [c.replace('sessionduration_', 'group_adherence_') for c in window_durations.columns]
+    return pd.DataFrame(flags, index=window_durations.index, columns=columns)
+
+def compute_metrics(inputs, partner_totals=None, window_edges=None, state_dir=None, chunksize=None,
+                    shards=None, max_workers=None):
+    """Combine the REDCap variables and partner totals of load_inputs() output into one row per sid:
+       the report values plus completed_70 ('1'/'0', None without randomization) and per-window
+       adherence flags. Partner totals are computed from inputs['partner'] unless given."""
+    import pandas as pd
+    mbi, sid, mbi_event_index = inputs['mbi'], inputs['sid'], inputs['mbi_event_index']
+    if partner_totals is None:
+        partner_totals = fold_partner_totals(inputs['partner'], sid, window_edges, state_dir, chunksize,
+                                             shards, max_workers)
+    # Variables of interest (one batch lookup per event)
+    with stage('gather_redcap', rows_in=len(mbi), participants=len(sid)) as info:
+        day1_data = gatherdata_batch(mbi, mbi_event_index, ['randomization', 'mri_comp_2'], 'day_1_arm_1', sid)
+        week4_data = gatherdata_batch(mbi, mbi_event_index, ['week_4_8_questionnaires_complete', 'week_4_debriefing_complete'],
+                                      'week_4_arm_1', sid)
+        info['rows_out'] = len(sid)
+    randomization = day1_data['randomization']                       # randomization at day_1
+
+    metrics = pd.DataFrame({
+        'sid': sid,
+        'randomization': pd.Series(randomization, dtype=object),
+        'mri_comp_2': pd.Series(day1_data['mri_comp_2'], dtype=object),  # MRI2 at day_1 (original variable name)
+        'week4_comp': pd.Series(week4_data['week_4_8_questionnaires_complete'], dtype=object),
+        'debfried_comp': pd.Series(week4_data['week_4_debriefing_complete'], dtype=object),  # preserved original typo name
+    })
+    totals = partner_totals.reset_index(drop=True)
+    for col in ['session_duration_sum', 'delta_snap_pre', 'delta_snap_post']:
+        metrics[col] = totals[col]
+    # session_duration + snapshots included
+    metrics['session_duration_snapsincluded'] = (totals['session_duration_sum']
+                                                 + totals['delta_snap_pre'] + totals['delta_snap_post'])
+    # per-window session durations (snapshots included, as compute_weeklyduration did)
+    window_columns = [c for c in totals.columns if c.startswith('sessionduration_wk')]
+    for col in window_columns:
+        metrics[col] = totals[col]
+    window_adherence = completed_windows(totals[window_columns], randomization)
+    for col in window_adherence.columns:
+        metrics[col] = window_adherence[col]
+
+    # Session type counts and session_stage_max / adherence_stage (from the aggregation engine)
+    metrics['sessiontype_journey_totalcount'] = totals['sessiontype_journey_totalcount']
+    metrics['sessiontype_standalonesnap_totalcount'] = totals['sessiontype_standalonesnap_totalcount']
+    # strip leading 'S' from session_stage_max entries (as original did)
+    metrics['session_stage_max'] = [s.strip('S') if isinstance(s, str) else s for s in totals['session_stage_max']]
+    metrics['adherence_stage'] = totals['adherence_stage']
+
+    # completed_70 (overall across the study period) - original uses '0' for MBI and '1' for control
+    completed_70 = []
+    for rand, total in zip(randomization, metrics['session_duration_snapsincluded']):
+        if rand == '0':
+            completed_70.append('1' if int(total) > seventypercent_mod1to4 else '0')
+        elif rand == '1':
+            completed_70.append('1' if int(total) > seventypercent_controllen else '0')
+        else:
+            completed_70.append(None)
+    metrics['completed_70'] = pd.Series(completed_70, dtype=object)
+
+    # vital summaries (study-period means and per-window pre-post deltas)
+    for col in vital_columns(totals.columns):
+        metrics[col] = totals[col]
+    return metrics
+
+def vital_columns(columns):
+    """The vital summary columns among columns, in order."""
+    return [c for c in columns if c.startswith(tuple(f'{vital}_' for vital in VITAL_NAMES))]
+
+def write_vitals(metrics, vitals_file):
+    """Write one row per sid with the vital summaries (blank where a participant has no value)."""
+    os.makedirs(os.path.dirname(vitals_file), exist_ok=True)
+    metrics[['sid'] + vital_columns(metrics.columns)].to_csv(vitals_file, index=False)
+    print("Vital summaries written to:", vitals_file)
+
+# -------------------------
+# Report assembly: output columns taken straight from the per-sid metrics
+# -------------------------
+# (header, metrics column) of the legacy report around the per-window columns, in the original zip order
+LEGACY_HEAD = [('sid', 'sid'), ('randomization', 'randomization'), ('MRI2 Completed', 'mri_comp_2'),
+               ('Week4 Qs Completed', 'week4_comp'), ('debreifed', 'debfried_comp'),
+               ('session_duration_sum', 'session_duration_sum'),
+               ('session_duration+snapshots', 'session_duration_snapsincluded')]
+LEGACY_TAIL = [('sessiontype_journey_totalcount', 'sessiontype_journey_totalcount'),
+               ('sessiontype_standalonesnap_totalcount', 'sessiontype_standalonesnap_totalcount'),
+               ('session_stage_max', 'session_stage_max'), ('adherence_stage', 'adherence_stage')]
+
+def legacy_summary(metrics):
+    """The zone label and the two group count/adherence labels of the legacy report (original logic)."""
+    randomization = metrics['randomization']
+    completed = metrics['completed_70'] == '1'
+    total_mbi = int((randomization == '0').sum())
+    total_control = int((randomization == '1').sum())
+    completed_70_mbi = int(((randomization == '0') & completed).sum())
+    completed_70_control = int(((randomization == '1') & completed).sum())
+
+    # zone label calculation: replicate original (note original expression has odd precedence)
+    zone_percentage = (completed_70_mbi + completed_70_control / total_mbi + total_control)
+    if zone_percentage < 50:
+        zone_label = ('RED Zone: ' + str(int(zone_percentage)) + '% of all listed participants completed 70% of app activity')
+    if zone_percentage > 49 and zone_percentage < 71:
+        zone_label = ('AMBER Zone: ' + str(int(zone_percentage)) + '% of all listed participants completed 70% of app activity')
+    if zone_percentage > 70:
+        zone_label = ('GREEN Zone: ' + str(int(zone_percentage)) + '% of all listed participants completed 70% of app activity')
+
+    group_num = ['GROUPA group count: ' + str(total_mbi), 'GROUPB group count: ' + str(total_control)]
+    group_adherence = [
+        'GROUPA adherence (threshold of 7492, or 70% of modules 1 through 4 [10688]): ' + str(completed_70_mbi) + '/' + str(total_mbi),
+        'GROUPB adherence (threshold of 6720s, or 70% of 16 sham sessions [9600s]): ' + str(completed_70_control) + '/' + str(total_control)]
+    return zone_label, group_num, group_adherence
+
+def legacy_row_blocks(metrics, chunk_rows=None):
+    """Yield the rows of the legacy report in blocks of at most chunk_rows: zone/group summaries in the
+       first three columns, a header row, then one row per sid. Like the original zip of the
+       header-prefixed lists, the report has max(len(sid), 1) rows, so the last sid is not listed.
+       A combined report (metrics with a 'cohort' column) lists the cohort before the sid."""
+    chunk_rows = chunk_rows or REPORT_CHUNK_ROWS
+    zone_label, group_num, group_adherence = legacy_summary(metrics)
+    window_columns = [(c, c) for c in metrics.columns if c.startswith('sessionduration_wk')]
+    columns = LEGACY_HEAD + window_columns + LEGACY_TAIL
+    if 'cohort' in metrics.columns:
+        columns = [('cohort', 'cohort')] + columns
+    n_rows = max(len(metrics), 1)
+
+    def summary_cell(labels, row):
+        return labels[row] if row < len(labels) else ''
+
+    yield [[zone_label, group_num[0], group_adherence[0]] + [header for header, _ in columns]]
+    for lo in range(1, n_rows, chunk_rows):
+        hi = min(lo + chunk_rows, n_rows)
+        # report row r holds sid r - 1
+        values = [metrics[col].iloc[lo - 1:hi - 1].tolist() for _, col in columns]
+        summaries = [('', summary_cell(group_num, r), summary_cell(group_adherence, r)) for r in range(lo, hi)]
+        yield [list(summary) + list(cells) for summary, cells in zip(summaries, zip(*values))]
+
+def build_report(metrics):
+    """Return the legacy report as a DataFrame (original header-in-row layout, see legacy_row_blocks)."""
+    import pandas as pd
+    return pd.DataFrame([row for block in legacy_row_blocks(metrics) for row in block])
+
+def write_report(report, output_file):
+    """Write the report CSV without header/index (like original)."""
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    report.to_csv(output_file, header=False, index=False)
+    print("Adherence report written to:", output_file)
+
+def write_legacy_csv(metrics, output_file, chunk_rows=None):
+    """Stream the legacy report to output_file block by block; the bytes match write_report(build_report())."""
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    with open(output_file, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f, lineterminator=os.linesep)
+        for block in legacy_row_blocks(metrics, chunk_rows):
+            writer.writerows(block)
+    print("Adherence report written to:", output_file)
+
+def write_tidy_csv(metrics, output_file, chunk_rows=None):
+    """One header row and one row per participant with every metric (window flags, completed_70,
+       vitals, ...), written chunk_rows rows at a time."""
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    metrics.to_csv(output_file, index=False, chunksize=chunk_rows or REPORT_CHUNK_ROWS)
+    print("Tidy report written to:", output_file)
+
+def write_arrow(metrics, output_file, fmt, chunk_rows=None):
+    """Write the tidy metrics as Parquet or Feather (Arrow IPC file), one record batch / row group of
+       chunk_rows rows at a time (pyarrow required)."""
+    import pyarrow as pa
+    chunk_rows = chunk_rows or REPORT_CHUNK_ROWS
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    schema = pa.Schema.from_pandas(metrics, preserve_index=False)
+    if fmt == 'parquet':
+        import pyarrow.parquet as pq
+        writer = pq.ParquetWriter(output_file, schema)
     else:
+        writer = pa.ipc.new_file(output_file, schema)
+    with writer:
+        for lo in range(0, len(metrics), chunk_rows):
+            writer.write_table(pa.Table.from_pandas(metrics.iloc[lo:lo + chunk_rows], schema=schema, preserve_index=False))
+    print(f"{fmt.capitalize()} report written to:", output_file)
+
+def report_files(output_file):
+    """Output path of every report format, next to the legacy report output_file."""
+    base = os.path.splitext(output_file)[0]
+    return {'legacy': output_file, 'tidy': base + '_tidy.csv', 'parquet': base + '.parquet',
+            'feather': base + '.feather'}
+
+def check_report_formats(formats=None):
+    """Fail early on unknown REPORT_FORMATS, or Parquet/Feather without pyarrow."""
+    formats = REPORT_FORMATS if formats is None else formats
+    unknown = [fmt for fmt in formats if fmt not in ('legacy', 'tidy', 'parquet', 'feather')]
+    if unknown:
+        raise ValueError(f"unknown report format(s) {unknown} (use legacy, tidy, parquet, feather)")
+    if any(fmt in ('parquet', 'feather') for fmt in formats) and not feather_available():
+        raise ImportError("Parquet/Feather reports need pyarrow (pip install pyarrow)")
+
+def write_outputs(metrics, output_file, formats=None):
+    """Write the report in every REPORT_FORMATS format (paths from report_files(output_file))."""
+    formats = REPORT_FORMATS if formats is None else formats
+    files = report_files(output_file)
+    for fmt in formats:
+        if fmt == 'legacy':
+            write_legacy_csv(metrics, files['legacy'])
+        elif fmt == 'tidy':
+            write_tidy_csv(metrics, files['tidy'])
+        else:
+            write_arrow(metrics, files[fmt], fmt)
+
+# -------------------------
+# Run one cohort folder
+# -------------------------
+def cohort_metrics(directory, shards=None, max_workers=None):
+    """Per-participant metrics of one cohort folder (raw/ inputs). All three files are checked before
+       anything is parsed; then PartnerReport is folded while the REDCap export is read (the fold only
+       waits for the short outcome list, which gives the sids). A sharded fold forks worker processes,
+       so it only starts once the reader threads have finished. With COERCION_REPORT the coercion
+       report is written from the tallies taken while the inputs were converted."""
+    COERCION_SUMMARY.clear()
+    paths = input_paths(directory)
+    partner_file = paths['partner_file']
+    check_inputs(paths['mbi_file'], paths['outcome_file'], partner_file)
+    state_dir = os.path.join(directory, INCREMENTAL_STATE_SUBDIR) if INCREMENTAL_STATE_SUBDIR else None
+
+    def partner_totals(outcome):
+        return fold_partner_totals(partner_file, outcome_sids(outcome.result()), state_dir=state_dir,
+                                   chunksize=PARTNER_CHUNKSIZE, shards=shards, max_workers=max_workers)
+
+    with input_pool() as pool:
+        # submitted in dependency order, so a single thread reads them one after another
+        outcome = pool.submit(read_outcome, paths['outcome_file'])
+        totals = None if shards else pool.submit(partner_totals, outcome)
+        mbi = pool.submit(read_redcap, paths['mbi_file'])
+        inputs = index_inputs(mbi.result(), outcome.result(), partner_file)
+    # forking while other threads run can deadlock the child processes
+    totals = partner_totals(outcome) if shards else totals.result()
+    metrics = compute_metrics(inputs, partner_totals=totals)
+    if COERCION_REPORT:
+        write_coercion_report(directory, inputs)
+    return metrics
+
+def cohort_metrics_with_stats(directory):
+    """Worker: cohort_metrics() plus the stage stats of that cohort."""
+    STAGE_STATS.clear()
+    metrics = cohort_metrics(directory)
+    return metrics, dict(STAGE_STATS)
+
+def run_adherence_report(directory, shards=None, max_workers=None):
+    """Build and write output/adherence_report.csv (and the other REPORT_FORMATS) for one cohort folder;
+       returns the per-participant metrics. Stage timings go to the run log (RUN_LOG_NAME);
+       PROFILE_MODE wraps the run in a profiler."""
+    check_report_formats()
+    CSV_CACHE_STATS.update(hits=0, misses=0)
+    STAGE_STATS.clear()
+    output_file = input_paths(directory)['output_file']
+    output_dir = os.path.dirname(output_file)
+    started = datetime.datetime.now().isoformat(timespec='seconds')
+    t0 = time.perf_counter()
+    with profiled(PROFILE_MODE, output_dir):
+        metrics = cohort_metrics(directory, shards, max_workers)
+        with stage('write_report', rows_in=len(metrics), participants=len(metrics)):
+            write_outputs(metrics, output_file)
+            write_vitals(metrics, input_paths(directory)['vitals_file'])
+        memory = memory_source()
+    seconds = time.perf_counter() - t0
+    if CSV_CACHE_DIRNAME:
+        print(f"CSV cache: {CSV_CACHE_STATS['hits']} hits, {CSV_CACHE_STATS['misses']} misses")
+    write_run_log(output_dir, {'started': started, 'directory': directory, 'seconds': round(seconds, 6),
+                               'participants': len(metrics), 'memory': memory, 'profile': PROFILE_MODE,
+                               'csv_cache': dict(CSV_CACHE_STATS)})
+    return metrics
+
+# -------------------------
+# Multi-cohort runner (one worker process per cohort)
+# -------------------------
+def run_cohorts(directories, combined_output_file, max_workers=None):
+    """Process every cohort folder in parallel, write each cohort's report and a combined report over
+       all successful cohorts (a leading 'cohort' column holds the folder, as sids may repeat across
+       cohorts). A cohort whose inputs fail check_inputs() fails without being started.
+       Returns (metrics per cohort, {cohort: error} for failed cohorts)."""
+    import pandas as pd
+    from concurrent.futures import ProcessPoolExecutor
+    check_report_formats()
+    results = {}
+    failures = {}
+    stats = {}
+    started = datetime.datetime.now().isoformat(timespec='seconds')
+    for cohort in directories:
+        paths = input_paths(cohort)
         try:
-            parsed = datetime.datetime.strptime(start_norm, "%Y/%m/%d").date()
-        except Exception:
-            # fallback - try more flexible parsing
+            check_inputs(paths['mbi_file'], paths['outcome_file'], paths['partner_file'])
+        except (FileNotFoundError, ValueError) as e:
+            failures[cohort] = e
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=apply_settings, initargs=(current_settings(),)) as pool:
+        futures = {cohort: pool.submit(cohort_metrics_with_stats, cohort)
+                   for cohort in directories if cohort not in failures}
+        for cohort, future in futures.items():
             try:
-                parsed = pd.to_datetime(start_norm, errors='coerce').date()
-                if pd.isna(parsed):
-                    parsed = datetime.datetime.strptime("9999/01/01", "%Y/%m/%d").date()
-            except Exception:
-                parsed = datetime.datetime.strptime("9999/01/01", "%Y/%m/%d").date()
-    # update earliest per sid
-    if sid_val not in earliest_start or parsed < earliest_start[sid_val]:
-        earliest_start[sid_val] = parsed
-
-# For any sid in outcome list not present in partner, set sentinel earliest start
-for s in sid:
-    if s not in earliest_start:
-        earliest_start[s] = datetime.datetime.strptime("9999/01/01", "%Y/%m/%d").date()
-
-# Build week cutoffs per sid (week1 = +7d, week2 +14d, week3 +21d, week4 +56d as original)
-session_start_data = []   # list of datetime.date
-week_1_dates = []
-week_2_dates = []
-week_3_dates = []
-week_4_dates = []
-for s in sid:
-    start = earliest_start.get(s, datetime.datetime.strptime("9999/01/01", "%Y/%m/%d").date())
-    session_start_data.append(start)
-    week_1_dates.append(start + timedelta(days=7))
-    week_2_dates.append(start + timedelta(days=14))
-    week_3_dates.append(start + timedelta(days=21))
-    week_4_dates.append(start + timedelta(days=56))
-
-# -------------------------
-# Ensure numeric session_duration and heartrate_pre as original did (fill missing with 0)
-# -------------------------
-# For compatibility with original, iterate rows and coerce ints; where invalid set to '0'
-def safe_int_column(df, col):
-    if col is None:
-        return
-    for idx in df.index:
+                results[cohort], stats[cohort] = future.result()
+            except Exception as e:
+                failures[cohort] = e
+
+    for cohort, metrics in results.items():
         try:
-            # original attempted int conversion and set to 0 on exception
-            val = df.at[idx, df.columns[col]]
-            int(str(val))
-        except Exception:
-            df.at[idx, df.columns[col]] = "0"
+            output_file = input_paths(cohort)['output_file']
+            write_outputs(metrics, output_file)
+            write_vitals(metrics, input_paths(cohort)['vitals_file'])
+            # worker stages of this cohort (the worker's memory figures)
+            write_run_log(os.path.dirname(output_file), {'started': started, 'directory': cohort,
+                                                          'participants': len(metrics)}, stats[cohort])
+        except Exception as e:
+            failures[cohort] = e
+    succeeded = [c for c in directories if c in results and c not in failures]
+    if succeeded:
+        combined = pd.concat([results[c] for c in succeeded], keys=succeeded, names=['cohort', None])
+        combined = combined.reset_index(level='cohort').reset_index(drop=True)
+        if len(combined):
+            write_outputs(combined, combined_output_file)
 
-safe_int_column(partner, session_duration_index)
-safe_int_column(partner, heartrate_pre_index)
+    for cohort in directories:
+        status = "FAILED: " + repr(failures[cohort]) if cohort in failures else "ok"
+        print(f"Cohort {cohort}: {status}")
+    return results, failures
 
 # -------------------------
-# Compute total session_duration within 4-weeks per sid (cap at 3600s)
+# Coercion report: what the typed conversions did to every input column (counts and sample rows)
 # -------------------------
-session_duration_data = []
-for i_s, s in enumerate(sid):
-    total = 0
-    for _, row in partner.iterrows():
-        if str(row['sid']) == s:
-            # parse session_start_date to date (original used "%Y/%m/%d")
-            start_raw = str(row['session_start_date']).replace("-", "/")
-            try:
-                start_date = datetime.datetime.strptime(start_raw, "%Y/%m/%d").date()
-            except Exception:
-                # skip rows that can't be parsed; original replaced with sentinel earlier so keep that behavior
-                try:
-                    start_date = pd.to_datetime(start_raw, errors='coerce').date()
-                except Exception:
-                    start_date = datetime.datetime.strptime("9999/01/01", "%Y/%m/%d").date()
-            # include only if before week_4_dates[i_s]
-            if start_date < week_4_dates[i_s]:
-                # session_duration column contains strings potentially; coerce to int and cap
-                try:
-                    session_duration = int(float(row['session_duration']))
-                except Exception:
-                    session_duration = 0
-                if session_duration > DURATION_CAP:
-                    session_duration = DURATION_CAP
-                total += session_duration
-    session_duration_data.append(total)
-
-# -------------------------
-# Snapshot cleaning (mirror original clean_snapshot)
-# -------------------------
-# Apply snapshot_to_standard to each snapshot column
-for colname in ['snapshot_start_pre','snapshot_finish_pre','snapshot_start_post','snapshot_finish_post']:
-    if colname in partner.columns:
-        partner[colname] = partner[colname].apply(snapshot_to_standard)
+# columns the pipeline converts, by kind: PARTNER_SCHEMA plus the dates and snapshots prepare_partner parses
+#   date       blank/unparseable cells -> the '9999/01/01' sentinel day, without their session duration
+#   timestamp  NaT (the snapshot delta becomes 0)
+PARTNER_CHECKS = dict(PARTNER_SCHEMA, session_start_date='date', snapshot_start_pre='timestamp',
+                      snapshot_finish_pre='timestamp', snapshot_start_post='timestamp',
+                      snapshot_finish_post='timestamp')
+# REDCap values the metrics depend on: anything else gives a blank completed_70 for that participant
+RANDOMIZATION_VALUES = ['0', '1']
+COERCION_COLUMNS = ['file', 'column', 'kind', 'rows', 'blank', 'invalid', 'substituted', 'sample_rows',
+                    'sample_values']
+# PartnerReport tallies of the current cohort run ((file, column) -> entry, see tally), taken while the
+# report converts PartnerReport; shard workers return theirs and incremental runs keep them in the state
+COERCION_SUMMARY = {}
+
+def coercion_masks(values, converted, kind):
+    """Blank, invalid (non-blank but rejected) and substituted (replaced by 0 or the sentinel date rather
+       than left missing) cells of a raw string column, given its prepare_partner conversion under kind.
+       Returns three boolean arrays."""
+    import numpy as np
+    values = values.astype(str)
+    stripped = values.str.strip()
+    blank = ((stripped == "") | (stripped.str.lower() == "null")).to_numpy()
+    if kind == 'category':
+        rejected = blank
+    elif kind == 'int0':
+        # rejected cells are indistinguishable from a real 0 once converted
+        rejected = int_cells(values).isna()
     else:
-        # create column of 'null' if missing
-        partner[colname] = ["null"] * len(partner)
-
-# -------------------------
-# compute_delta_snap function (mirrors original)
-# -------------------------
-def compute_delta_snap(partner_df, sid_list, sid_col_name, session_start_col_name,
-                       week_4_dates_list, snapshot_start_col, snapshot_finish_col, start_point_list):
-    delta_snap_data = []
-    for idx_s, s in enumerate(sid_list):
-        delta_snap_lst = []
-        for _, row in partner_df.iterrows():
-            # guard: if snapshot entries equal 'null' set sentinel strings (original did that in-loop)
-            start_snap = row[snapshot_start_col]
-            finish_snap = row[snapshot_finish_col]
-            if start_snap == 'null':
-                start_snap = '1111/11/11/11/11/11'
-                finish_snap = '1111/11/11/11/11/11'
-            if finish_snap == 'null':
-                start_snap = '1111/11/11/11/11/11'
-                finish_snap = '1111/11/11/11/11/11'
-            # session start date parsing
-            session_start_raw = str(row[session_start_col_name]).replace("-", "/")
-            try:
-                a = datetime.datetime.strptime(session_start_raw, "%Y/%m/%d")
-            except Exception:
-                try:
-                    a = pd.to_datetime(session_start_raw, errors='coerce')
-                    if pd.isna(a):
-                        a = datetime.datetime.strptime("9999/01/01", "%Y/%m/%d")
-                except Exception:
-                    a = datetime.datetime.strptime("9999/01/01", "%Y/%m/%d")
-            # include if sid matches and within window (>= start_point and < week_4)
-            if str(row[sid_col_name]) == str(s) and a.date() < week_4_dates_list[idx_s] and a.date() >= start_point_list[idx_s]:
-                # parse snapshot datetimes formatted like 'YYYY/MM/DD/H/M/S'
-                dt_finish = parse_snapshot_datetime(finish_snap)
-                dt_start = parse_snapshot_datetime(start_snap)
-                # delta in seconds (original used .seconds attribute)
-                try:
-                    delta_snap = (dt_finish - dt_start).seconds
-                except Exception:
-                    delta_snap = 0
-                delta_snap_lst.append(int(delta_snap))
-        delta_snap_data.append(sum(delta_snap_lst))
-    return delta_snap_data
-
-delta_snap_pre_data = compute_delta_snap(partner, sid, 'sid', 'session_start_date', week_4_dates, 'snapshot_start_pre', 'snapshot_finish_pre', session_start_data)
-delta_snap_post_data = compute_delta_snap(partner, sid, 'sid', 'session_start_date', week_4_dates, 'snapshot_start_post', 'snapshot_finish_post', session_start_data)
-
-# -------------------------
-# session_duration + snapshots included
-# -------------------------
-session_duration_snapsincluded = []
-for i in range(len(session_duration_data)):
-    total = int(session_duration_data[i] if session_duration_data[i] is not None else 0) \
-            + int(delta_snap_pre_data[i] if i < len(delta_snap_pre_data) else 0) \
-            + int(delta_snap_post_data[i] if i < len(delta_snap_post_data) else 0)
-    session_duration_snapsincluded.append(total)
-
-# -------------------------
-# weekly session durations (mirrors compute_weeklyduration)
-# -------------------------
-def compute_weeklyduration(week_num_list, start_list):
-    session_duration_week = []
-    for idx_s, s in enumerate(sid):
-        total = 0
-        for _, row in partner.iterrows():
-            if str(row['sid']) == s:
-                # parse session start to date
-                start_raw = str(row['session_start_date']).replace("-", "/")
-                try:
-                    sess_date = datetime.datetime.strptime(start_raw, "%Y/%m/%d").date()
-                except Exception:
-                    try:
-                        sess_date = pd.to_datetime(start_raw, errors='coerce').date()
-                    except Exception:
-                        sess_date = datetime.datetime.strptime("9999/01/01", "%Y/%m/%d").date()
-                # include session if start >= start_list[idx_s] and < week_num_list[idx_s]
-                if sess_date < week_num_list[idx_s] and sess_date >= start_list[idx_s]:
-                    try:
-                        sd = int(float(row['session_duration']))
-                    except Exception:
-                        sd = 0
-                    if sd > DURATION_CAP:
-                        sd = DURATION_CAP
-                    total += sd
-        # after iterating all rows, append weekly session total
-        session_duration_week.append(total)
-    # compute snapshot deltas for same week window and add them
-    delta_pre = compute_delta_snap(partner, sid, 'sid', 'session_start_date', week_num_list, 'snapshot_start_pre', 'snapshot_finish_pre', start_list)
-    delta_post = compute_delta_snap(partner, sid, 'sid', 'session_start_date', week_num_list, 'snapshot_start_post', 'snapshot_finish_post', start_list)
-    session_duration_snaps = []
-    for i in range(len(session_duration_week)):
-        sc = int(session_duration_week[i]) + int(delta_pre[i]) + int(delta_post[i])
-        session_duration_snaps.append(sc)
-    return session_duration_snaps
-
-week_1_sessionduration = compute_weeklyduration(week_1_dates, session_start_data)
-week_2_sessionduration = compute_weeklyduration(week_2_dates, week_1_dates)
-week_3_sessionduration = compute_weeklyduration(week_3_dates, week_2_dates)
-week_4_sessionduration = compute_weeklyduration(week_4_dates, week_3_dates)
-
-# -------------------------
-# Determine completed_70 (overall across 4 weeks) - mirrors original logic exactly
-# -------------------------
-completed_70 = []
-completed_70_mbi = 0
-completed_70_control = 0
-total_mbi = 0
-total_control = 0
-mri_MBI_count = 0
-mri_control_count = 0
-
-for i in range(len(sid)):
-    # original uses '0' for MBI and '1' for control — use the same string comparison
-    if randomization[i] == '0':
-        total_mbi += 1
-        if int(session_duration_snapsincluded[i]) > seventypercent_mod1to4:
-            completed_70.append('1')
-            completed_70_mbi += 1
-        else:
-            completed_70.append('0')
-    if randomization[i] == '1':
-        total_control += 1
-        if int(session_duration_snapsincluded[i]) > seventypercent_controllen:
-            completed_70.append('1')
-            completed_70_control += 1
-        else:
-            completed_70.append('0')
+        rejected = converted.isna()
+    rejected = np.asarray(rejected, dtype=bool) | blank
+    substituted = rejected if kind in ('int0', 'date') else np.zeros(len(values), dtype=bool)
+    return blank, rejected & ~blank, substituted
+
+def delta_masks(partner_df, start_col, finish_col, legacy_seconds=None):
+    """Snapshot pairs of a prepared frame: finish before start (invalid; wrapped into [0, 86400) with
+       legacy_seconds, otherwise 0) and only one side valid (substituted: the delta becomes 0)."""
+    import numpy as np
+    if legacy_seconds is None:
+        legacy_seconds = SNAPSHOT_LEGACY_SECONDS
+    start, finish = partner_df[start_col], partner_df[finish_col]
+    one_side = (start.isna() != finish.isna()).to_numpy()
+    backwards = (finish < start).to_numpy()
+    return np.zeros_like(one_side), backwards, one_side | (backwards & (not legacy_seconds))
+
+def coercion_entry(summary, file, column, kind):
+    """summary[(file, column)], created empty on first use."""
+    return summary.setdefault((file, column), {'file': file, 'column': column, 'kind': kind, 'rows': 0,
+                                               'blank': 0, 'invalid': 0, 'substituted': 0,
+                                               'sample_rows': [], 'sample_values': []})
+
+def add_sample_values(entry, values):
+    """Append the values not sampled yet to entry['sample_values'], up to COERCION_SAMPLE_ROWS."""
+    for v in values:
+        if len(entry['sample_values']) >= COERCION_SAMPLE_ROWS:
+            break
+        if v not in entry['sample_values']:
+            entry['sample_values'].append(v)
+
+def tally(summary, file, column, kind, rows, values, blank, invalid, substituted):
+    """Add the masks of one column (of one chunk) to summary[(file, column)]; rows are the data row
+       numbers (1 = first row below the header) and values the raw cells."""
+    import numpy as np
+    entry = coercion_entry(summary, file, column, kind)
+    entry['rows'] += len(blank)
+    for name, mask in [('blank', blank), ('invalid', invalid), ('substituted', substituted)]:
+        entry[name] += int(np.count_nonzero(mask))
+    bad = np.flatnonzero(blank | invalid | substituted)
+    room = COERCION_SAMPLE_ROWS - len(entry['sample_rows'])
+    entry['sample_rows'] += [int(r) for r in np.asarray(rows)[bad[:room]]]
+    if values is not None:
+        add_sample_values(entry, np.asarray(values, dtype=object)[np.flatnonzero(invalid)])
+
+def merge_coercion(summary, other, rows_before=0):
+    """Add the tallies of other (taken over rows that follow rows_before earlier rows) to summary."""
+    for entry in other.values():
+        target = coercion_entry(summary, entry['file'], entry['column'], entry['kind'])
+        for name in ['rows', 'blank', 'invalid', 'substituted']:
+            target[name] += entry[name]
+        room = COERCION_SAMPLE_ROWS - len(target['sample_rows'])
+        target['sample_rows'] += [r + rows_before for r in entry['sample_rows'][:room]]
+        add_sample_values(target, entry['sample_values'])
+
+def partner_coercion(raw, prepared, summary, first_row=1, file="PartnerReport.csv"):
+    """Tally every PARTNER_CHECKS column and both snapshot deltas of one PartnerReport chunk (raw: its
+       cells as read, blanks as "", prepared: the prepare_partner frame) into summary; first_row is the
+       data row number of the chunk's first row."""
+    import numpy as np
+    n_rows = len(raw)
+    rows = np.arange(first_row, first_row + n_rows)
+    with stage('coercion_tally', rows_in=n_rows) as info:
+        for column, kind in PARTNER_CHECKS.items():
+            if column in raw.columns:
+                tally(summary, file, column, kind, rows, raw[column],
+                      *coercion_masks(raw[column], prepared[column], kind))
+        for part in ['pre', 'post']:
+            tally(summary, file, f'delta_snap_{part}', 'delta', rows, None,
+                  *delta_masks(prepared, f'snapshot_start_{part}', f'snapshot_finish_{part}'))
+        info['rows_out'] = n_rows
+
+def redcap_coercion(inputs, mbi_file, outcome_file, summary):
+    """Tally the REDCap keys (blank record_id / redcap_event_name), the day 1 randomization of the
+       listed sids (outside RANDOMIZATION_VALUES) and the outcome sids without REDCap rows into summary."""
+    import numpy as np
+    import pandas as pd
+    mbi, sid = inputs['mbi'], inputs['sid']
+    file = os.path.basename(mbi_file)
+    rows = mbi.index.to_numpy() + 1
+    for column in ['record_id', 'redcap_event_name']:
+        blank = (mbi[column].astype(str).str.strip() == "").to_numpy()
+        tally(summary, file, column, 'key', rows, None, blank, np.zeros_like(blank), np.zeros_like(blank))
+    day1 = mbi[(mbi['redcap_event_name'] == 'day_1_arm_1') & mbi['record_id'].isin(sid)]
+    if 'randomization' in mbi.columns:
+        values = day1['randomization'].astype(str)
+        blank = (values.str.strip() == "").to_numpy()
+        invalid = ~values.isin(RANDOMIZATION_VALUES).to_numpy() & ~blank
+        tally(summary, file, 'randomization', 'choice', day1.index.to_numpy() + 1, values, blank, invalid,
+              np.zeros_like(blank))
+    known = pd.Series(sid).isin(mbi['record_id'])
+    missing = ~known.to_numpy()
+    tally(summary, os.path.basename(outcome_file), 'sid', 'key', np.arange(len(sid)) + 1, pd.Series(sid),
+          np.zeros_like(missing), missing, np.zeros_like(missing))
+
+def coercion_report(directory, inputs):
+    """One row per checked input column of a cohort folder (COERCION_COLUMNS): rows read, blank,
+       invalid and substituted cells, and the first COERCION_SAMPLE_ROWS problem rows and invalid values.
+       The REDCap checks run on the loaded inputs, the PartnerReport rows come from the tallies taken
+       while the report folded it (COERCION_SUMMARY)."""
+    import pandas as pd
+    paths = input_paths(directory)
+    summary = {}
+    with stage('coercion_report') as info:
+        redcap_coercion(inputs, paths['mbi_file'], paths['outcome_file'], summary)
+        merge_coercion(summary, COERCION_SUMMARY)
+        report = pd.DataFrame(list(summary.values()), columns=COERCION_COLUMNS)
+        report['sample_rows'] = [' '.join(str(r) for r in rs) for rs in report['sample_rows']]
+        report['sample_values'] = ['|'.join(vs) for vs in report['sample_values']]
+        info['rows_out'] = len(report)
+    return report
+
+def write_coercion_report(directory, inputs):
+    """Write output/coercion_report.csv for one cohort folder and print the columns with problems."""
+    report = coercion_report(directory, inputs)
+    output_file = os.path.join(os.path.dirname(input_paths(directory)['output_file']), "coercion_report.csv")
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    report.to_csv(output_file, index=False)
+    for r in report[(report['blank'] + report['invalid'] + report['substituted']) > 0].itertuples():
+        print(f"Coerced {r.file}:{r.column}: {r.blank} blank, {r.invalid} invalid, {r.substituted} substituted"
+              f" of {r.rows} (rows {r.sample_rows})")
+    print("Coercion report written to:", output_file)
+    return report
 
 # -------------------------
-# weekly adherence binary (completed_weekly function in original)
+# Threshold sensitivity sweep: every duration cap x adherence percentage from one pass over PartnerReport
 # -------------------------
-def completed_weekly(week):
-    out = []
-    for i in range(len(sid)):
-        if randomization[i] == '0':
-            # MBI
-            if int(week[i]) > avg_weekly:
-                out.append('1')
-            else:
-                out.append('0')
-        elif randomization[i] == '1':
-            # Control
-            if int(week[i]) > avg_weekly_con:
-                out.append('1')
-            else:
-                out.append('0')
-        else:
-            out.append('0')
-    return out
-
-week_1_adh = completed_weekly(week_1_sessionduration)
-week_2_adh = completed_weekly(week_2_sessionduration)
-week_3_adh = completed_weekly(week_3_sessionduration)
-week_4_adh = completed_weekly(week_4_sessionduration)
-
-# -------------------------
-# Count standalone and journey sessions per sid (mirrors original loops)
-# -------------------------
-number_of_standalones = []
-number_of_journeys = []
-
-for s in sid:
-    n_st = 0
-    n_jy = 0
-    for _, row in partner.iterrows():
-        if str(row['sid']) == s:
-            typ = str(row.get('session_type', ''))
-            if 'Standalone' in typ:
-                n_st += 1
-            if 'Journey' in typ:
-                n_jy += 1
-    number_of_standalones.append(n_st)
-    number_of_journeys.append(n_jy)
-
-# -------------------------
-# session_stage_max and adherence_stage (same logic as original)
-# -------------------------
-session_stage_max = []
-adherence_stage = []
-for s in sid:
-    stages = []
-    for _, row in partner.iterrows():
-        if str(row['sid']) == s:
-            stages.append(row.get('session_stage', ''))
-    if not stages:
-        adherence_stage.append('0')
-        session_stage_max.append('0')
+# grid of per-session duration caps (seconds) and adherence percentages; the overall thresholds are
+# percent * modules1to4_sum (MBI) / control_len (control), the weekly ones percent * weekly_len /
+# weekly_len_con. The (DURATION_CAP, 0.7) cell reproduces completed_70 and group_adherence_wk1..n
+SWEEP_CAPS = [1800, 2700, 3600, 5400, 7200]
+SWEEP_PERCENTS = [0.5, 0.6, 0.7, 0.8, 0.9]
+
+def sweep_partner_days(partner_file, sid_list, caps, chunksize=None):
+    """Fold PartnerReport once into one row per (sid, session_start_date) with the snapshot seconds
+       ('snaps') and the session durations capped at every cap (columns cap_0..cap_k, in caps order)."""
+    import numpy as np
+    import pandas as pd
+    caps = np.asarray(caps, dtype='int64')
+    cap_columns = [f'cap_{k}' for k in range(len(caps))]
+    if chunksize:
+        chunks = safe_read_csv(partner_file, chunksize=chunksize)
     else:
-        max_stage = max(stages)
-        session_stage_max.append(max_stage)
-        if max_stage > 'S20':
-            adherence_stage.append('1')
-        else:
-            adherence_stage.append('0')
-
-# strip leading 'S' from session_stage_max entries (as original did)
-session_stage_max = [s.strip('S') if isinstance(s, str) else s for s in session_stage_max]
-
-# Insert header rows at position 0 for lists that original inserted headers into
-# Build the header-containing lists according to the original final zip order
-sid_with_header = sid.copy()
-sid_with_header.insert(0, 'sid')
-
-randomization.insert(0, "randomization")
-
-# zone label calculation: replicate original (note original expression has odd precedence)
-zone_percentage = (completed_70_mbi + completed_70_control / total_mbi + total_control)
-if zone_percentage < 50:
-    zone_label = ('RED Zone: ' + str(int(zone_percentage)) + '% of all listed participants completed 70% of app activity')
-if zone_percentage > 49 and zone_percentage < 71:
-    zone_label = ('AMBER Zone: ' + str(int(zone_percentage)) + '% of all listed participants completed 70% of app activity')
-if zone_percentage > 70:
-    zone_label = ('GREEN Zone: ' + str(int(zone_percentage)) + '% of all listed participants completed 70% of app activity')
-
-zone_label_lst = [zone_label] + [''] * (len(sid) - 1 if len(sid) >= 1 else 0)
-
-group_num_lst = []
-group_num_lst.append('GROUPA group count: ' + str(total_mbi))
-group_num_lst.append('GROUPB group count: ' + str(total_control))
-for _ in range(2, len(sid)):
-    group_num_lst.append('')
-
-group_adherence_lst = []
-group_adherence_lst.append('GROUPA adherence (threshold of 7492, or 70% of modules 1 through 4 [10688]): ' + str(completed_70_mbi) + '/' + str(total_mbi))
-group_adherence_lst.append('GROUPB adherence (threshold of 6720s, or 70% of 16 sham sessions [9600s]): ' + str(completed_70_control) + '/' + str(total_control))
-for _ in range(2, len(sid)):
-    group_adherence_lst.append('')
-
-# insert headers for many vectors to match original output
-debfried_comp.insert(0, "debreifed")
-week_1_adh.insert(0, "group_adherence_wk1_70% of activity weekly avg")
-week_2_adh.insert(0, "group_adherence_wk2")
-week_3_adh.insert(0, "group_adherence_wk3")
-week_4_adh.insert(0, "group_adherence_wk4")
-week_1_sessionduration.insert(0, "sessionduration_wk1")
-week_2_sessionduration.insert(0, "sessionduration_wk2")
-week_3_sessionduration.insert(0, "sessionduration_wk3")
-week_4_sessionduration.insert(0, "sessionduration_wk4")
-session_duration_data.insert(0, "session_duration_sum")
-session_duration_snapsincluded.insert(0, "session_duration+snapshots")
-delta_snap_post_data.insert(0, "delta_snap_post")
-delta_snap_pre_data.insert(0, "delta_snap_pre")
-completed_70.insert(0, "completed_70%_of_groupactivity?")
-number_of_standalones.insert(0, "sessiontype_standalonesnap_totalcount")
-number_of_journeys.insert(0, "sessiontype_journey_totalcount")
-mri_comp_2.insert(0, 'MRI2 Completed')
-week4_comp.insert(0, "Week4 Qs Completed")
-session_stage_max.insert(0, 'session_stage_max')
-adherence_stage.insert(0, 'adherence_stage')
-
-# combine lists in same order as original
-output = list(zip(
-    zone_label_lst,
-    group_num_lst,
-    group_adherence_lst,
-    sid_with_header,
-    randomization,
-    mri_comp_2,
-    week4_comp,
-    debfried_comp,
-    session_duration_data,
-    session_duration_snapsincluded,
-    week_1_sessionduration,
-    week_2_sessionduration,
-    week_3_sessionduration,
-    week_4_sessionduration,
-    number_of_journeys,
-    number_of_standalones,
-    session_stage_max,
-    adherence_stage
-))
-
-# create DataFrame and write CSV without header/index (like original)
-out_df = pd.DataFrame(output)
-out_df.to_csv(output_file, header=False, index=False)
-
-print("Adherence report written to:", output_file)
+        with stage('read_partner') as info:
+            chunks = [safe_read_csv(partner_file)]
+            info['rows_out'] = len(chunks[0])
+    days = pd.DataFrame(columns=['sid', 'session_start_date', 'snaps'] + cap_columns)
+    for chunk in timed_reads(chunks, 'read_partner' if chunksize else None):
+        # capped once at the largest cap: min(min(d, max cap), cap) == min(d, cap) for every smaller cap
+        rows = session_row_metrics(prepare_partner(chunk), duration_cap=int(caps.max()), vitals=False)
+        with stage('sweep_fold', rows_in=len(rows)) as info:
+            rows = rows[rows['sid'].isin(sid_list)]
+            capped = np.minimum(rows['session_duration'].to_numpy()[:, None], caps[None, :])
+            part = pd.DataFrame(capped, columns=cap_columns, index=rows.index)
+            part.insert(0, 'snaps', rows['delta_snap_pre'] + rows['delta_snap_post'])
+            part.insert(0, 'session_start_date', rows['session_start_date'])
+            part.insert(0, 'sid', rows['sid'])
+            frames = [days, part] if len(days) else [part]
+            days = pd.concat(frames, ignore_index=True).groupby(['sid', 'session_start_date'], sort=False).sum()
+            days = days.reset_index()
+            info['rows_out'] = len(days)
+    return days
+
+def sweep_totals(days, sid_list, n_caps, window_edges=None):
+    """Per-sid durations (snapshots included) for every cap from the sweep fold, in sid_list order:
+       study-period totals (n_sids x n_caps) and per-window totals (n_sids x n_windows x n_caps)."""
+    import numpy as np
+    import pandas as pd
+    if window_edges is None:
+        window_edges = WINDOW_EDGES_DAYS
+    sids = pd.Index(sid_list, dtype=object).unique()
+    codes = sids.get_indexer(days['sid'])
+    start = days['session_start_date']
+    offset = (start - start.groupby(days['sid']).transform('min')).dt.days.to_numpy()
+    window = bin_sessions(offset, window_edges)
+    in_study = offset < window_edges[-1]
+    values = (days[[f'cap_{k}' for k in range(n_caps)]].to_numpy(dtype='int64')
+              + days['snaps'].to_numpy(dtype='int64')[:, None])
+
+    overall = np.zeros((len(sids), n_caps), dtype='int64')
+    np.add.at(overall, codes[in_study], values[in_study])
+    # window 0 collects the days outside every window and is dropped
+    windows = np.zeros((len(sids), len(window_edges), n_caps), dtype='int64')
+    np.add.at(windows, (codes, window), values)
+    order = sids.get_indexer(sid_list)
+    return overall[order], windows[order, 1:]
+
+def sweep_cells(caps, percents, weekly_percents=None):
+    """(cap index, percent index, weekly percent index) of every grid cell; without weekly_percents the
+       weekly percentage is the overall one."""
+    import itertools
+    if weekly_percents is None:
+        return [(c, p, p) for c, p in itertools.product(range(len(caps)), range(len(percents)))]
+    return list(itertools.product(range(len(caps)), range(len(percents)), range(len(weekly_percents))))
+
+def evaluate_sweep(overall, windows, randomization, caps, percents, weekly_percents=None):
+    """Adherence flags of every sid in every grid cell, as one comparison per flag type:
+       completed (n_sids x n_cells; completed_70, undefined without randomization), weekly
+       (n_sids x n_windows x n_cells; group_adherence_wk1..n) and the cell table (cap, percents,
+       thresholds)."""
+    import numpy as np
+    import pandas as pd
+    cap_k, pct_k, weekly_k = np.array(sweep_cells(caps, percents, weekly_percents)).T
+    percents = np.asarray(percents, dtype=float)
+    weekly_percents = percents if weekly_percents is None else np.asarray(weekly_percents, dtype=float)
+    rand = np.asarray(randomization, dtype=object)
+    mbi, control = (rand == '0')[:, None], (rand == '1')[:, None]
+
+    # per-sid thresholds for every percentage: MBI ('0'), control ('1'), anything else never adherent
+    overall_thr = np.where(mbi, modules1to4_sum * percents, np.where(control, control_len * percents, np.inf))
+    weekly_thr = np.where(mbi, weekly_len * weekly_percents,
+                          np.where(control, weekly_len_con * weekly_percents, np.inf))
+    completed = overall[:, cap_k] > overall_thr[:, pct_k]
+    weekly = windows[:, :, cap_k] > weekly_thr[:, None, weekly_k]
+
+    table = pd.DataFrame({
+        'duration_cap': np.asarray(caps)[cap_k],
+        'percent': percents[pct_k],
+        'weekly_percent': weekly_percents[weekly_k],
+        'mbi_threshold': modules1to4_sum * percents[pct_k],
+        'control_threshold': control_len * percents[pct_k],
+        'mbi_weekly_threshold': weekly_len * weekly_percents[weekly_k],
+        'control_weekly_threshold': weekly_len_con * weekly_percents[weekly_k],
+    })
+    return completed, weekly, table
+
+def threshold_sweep(inputs, caps=None, percents=None, weekly_percents=None, window_edges=None, chunksize=None):
+    """Sensitivity of the adherence classification to the duration cap and the thresholds for the
+       load_inputs() output. Returns (groups: one row per grid cell with the per-group counts of
+       completed_70 and group_adherence_wk1..n, participants: one row per sid and cell)."""
+    import numpy as np
+    import pandas as pd
+    caps = SWEEP_CAPS if caps is None else caps
+    percents = SWEEP_PERCENTS if percents is None else percents
+    sid = inputs['sid']
+    days = sweep_partner_days(inputs['partner'], sid, caps, chunksize)
+    with stage('gather_redcap', participants=len(sid)) as info:
+        randomization = gatherdata_batch(inputs['mbi'], inputs['mbi_event_index'], ['randomization'],
+                                         'day_1_arm_1', sid)['randomization']
+        info['rows_out'] = len(sid)
+    with stage('sweep_evaluate', rows_in=len(days), participants=len(sid)) as info:
+        overall, windows = sweep_totals(days, sid, len(caps), window_edges)
+        completed, weekly, groups = evaluate_sweep(overall, windows, randomization, caps, percents,
+                                                   weekly_percents)
+        n_cells, n_windows = len(groups), windows.shape[1]
+        rand = np.asarray(randomization, dtype=object)
+        mbi, control = rand == '0', rand == '1'
+        groups['total_mbi'] = int(mbi.sum())
+        groups['total_control'] = int(control.sum())
+        groups['completed_70_mbi'] = completed[mbi].sum(axis=0)
+        groups['completed_70_control'] = completed[control].sum(axis=0)
+        for k in range(n_windows):
+            groups[f'group_adherence_wk{k + 1}_mbi'] = weekly[mbi, k].sum(axis=0)
+            groups[f'group_adherence_wk{k + 1}_control'] = weekly[control, k].sum(axis=0)
+
+        # long format: the sids of cell 0, then of cell 1, ...
+        cell = np.repeat(np.arange(n_cells), len(sid))
+        participants = groups[['duration_cap', 'percent', 'weekly_percent']].iloc[cell].reset_index(drop=True)
+        participants.insert(0, 'randomization', np.tile(rand, n_cells))
+        participants.insert(0, 'sid', np.tile(np.asarray(sid, dtype=object), n_cells))
+        cap_k = np.array([c for c, _, _ in sweep_cells(caps, percents, weekly_percents)])
+        participants['session_duration_snapsincluded'] = overall[:, cap_k].T.ravel()
+        flags = pd.array(completed.T.ravel().astype('int8'), dtype='Int8')
+        flags[~np.tile(mbi | control, n_cells)] = pd.NA
+        participants['completed_70'] = flags
+        for k in range(n_windows):
+            participants[f'group_adherence_wk{k + 1}'] = weekly[:, k].T.ravel().astype('int8')
+        info['rows_out'] = len(participants)
+    return groups, participants
+
+def run_threshold_sweep(directory, caps=None, percents=None, weekly_percents=None):
+    """Run threshold_sweep() for one cohort folder and write output/threshold_sweep_groups.csv and
+       output/threshold_sweep_participants.csv; returns both tables."""
+    paths = input_paths(directory)
+    inputs = load_inputs(paths['mbi_file'], paths['outcome_file'], paths['partner_file'])
+    groups, participants = threshold_sweep(inputs, caps, percents, weekly_percents, chunksize=PARTNER_CHUNKSIZE)
+    output_dir = os.path.dirname(paths['output_file'])
+    os.makedirs(output_dir, exist_ok=True)
+    for name, table in [('threshold_sweep_groups.csv', groups), ('threshold_sweep_participants.csv', participants)]:
+        table.to_csv(os.path.join(output_dir, name), index=False)
+        print("Threshold sweep written to:", os.path.join(output_dir, name))
+    return groups, participants
+
+# -------------------------
+# Daily engagement index: per participant, seconds per day since the first session and their prefix sums
+# -------------------------
+# days since the first session kept in the index; later days (e.g. the '9999/01/01' sentinel) are left out
+ENGAGEMENT_MAX_DAYS = 3660
+
+def current_partner_days(partner_file, sid_list, state_dir=None, chunksize=None):
+    """The folded per-(sid, day) state of PartnerReport: the incremental state in state_dir when its
+       watermark covers the whole current file (same settings and outcome list), otherwise a fresh fold.
+       The state itself is never updated here, so the next incremental report run is unaffected."""
+    import pandas as pd
+    if state_dir:
+        days_file = os.path.join(state_dir, "partner_days.pkl")
+        watermark_file = os.path.join(state_dir, "watermark.json")
+        if os.path.exists(days_file) and os.path.exists(watermark_file):
+            with open(watermark_file) as f:
+                watermark = json.load(f)
+            size = os.path.getsize(partner_file)
+            if (watermark.get('fingerprint') == state_fingerprint(sid_list) and watermark['n_bytes'] == size
+                    and file_prefix_sha256(partner_file, size) == watermark['sha256']):
+                return pd.read_pickle(days_file)
+    days, _ = stream_partner_days(partner_file, sid_list, chunksize)
+    return days
+
+def daily_engagement_index(days, sid_list, max_days=None):
+    """Build the daily engagement index from the folded per-(sid, day) state: for every sid of sid_list,
+       the capped session duration plus snapshot seconds of each day 0..n-1 since its first session and
+       their running sums, all in one flat array. Returns a dict with 'sids' (Index), 'first_day',
+       'n_days', 'start' (position of each sid's leading 0 in 'cumulative') and 'cumulative'."""
+    import numpy as np
+    import pandas as pd
+    if max_days is None:
+        max_days = ENGAGEMENT_MAX_DAYS
+    with stage('engagement_index', rows_in=len(days), participants=len(sid_list)) as info:
+        sids = pd.Index(sid_list, dtype=object).unique()
+        start_date = days['session_start_date']
+        first = start_date.groupby(days['sid']).transform('min')
+        offset = (start_date - first).dt.days.to_numpy()
+        seconds = (days['session_duration'] + days['delta_snap_pre'] + days['delta_snap_post']).to_numpy()
+        codes = sids.get_indexer(days['sid'])
+        keep = (codes >= 0) & (offset < max_days)
+        codes, offset, seconds = codes[keep], offset[keep], seconds[keep]
+
+        n_days = np.zeros(len(sids), dtype='int64')
+        np.maximum.at(n_days, codes, offset + 1)
+        first_day = np.full(len(sids), np.datetime64('NaT'), dtype='datetime64[D]')
+        first_day[codes] = first.to_numpy()[keep].astype('datetime64[D]')
+        # segment k holds a leading 0 and then n_days[k] running sums; (sid, day) is unique in the fold
+        start = np.concatenate([[0], np.cumsum(n_days + 1)[:-1]]).astype('int64')
+        daily = np.zeros(int((n_days + 1).sum()), dtype='int64')
+        daily[start[codes] + offset + 1] = seconds
+        running = np.cumsum(daily)
+        cumulative = running - np.repeat(running[start], n_days + 1)
+        info['rows_out'] = int(n_days.sum())
+    return {'sids': sids, 'first_day': first_day, 'n_days': n_days, 'start': start, 'cumulative': cumulative}
+
+def window_seconds(index, sids, start_day, end_day):
+    """Engagement seconds of every sid in sids over days [start_day, end_day) since its first session
+       (day 0), from two lookups in the running sums; 0 for sids without sessions. The days may be
+       numbers or arrays matching sids."""
+    import numpy as np
+    codes = index['sids'].get_indexer(sids)
+    found = codes >= 0
+    codes = np.where(found, codes, 0)
+    n_days = index['n_days'][codes]
+    lo = np.clip(start_day, 0, n_days)
+    hi = np.maximum(np.clip(end_day, 0, n_days), lo)
+    start, cumulative = index['start'][codes], index['cumulative']
+    return np.where(found, cumulative[start + hi] - cumulative[start + lo], 0)
+
+def daily_engagement_frame(index):
+    """Long-format time series of the index: one row per sid and day from its first to its last
+       session day (sid, date, day, seconds, cumulative_seconds)."""
+    import numpy as np
+    import pandas as pd
+    n_days = index['n_days']
+    sid_k = np.repeat(np.arange(len(n_days)), n_days)
+    day = np.arange(int(n_days.sum())) - np.repeat(np.cumsum(n_days) - n_days, n_days)
+    position = index['start'][sid_k] + day + 1
+    cumulative = index['cumulative']
+    return pd.DataFrame({
+        'sid': index['sids'].to_numpy()[sid_k],
+        'date': index['first_day'][sid_k] + day,
+        'day': day,
+        'seconds': cumulative[position] - cumulative[position - 1],
+        'cumulative_seconds': cumulative[position],
+    })
+
+def cohort_engagement_index(directory):
+    """Daily engagement index of a cohort folder for the sids of its outcome list."""
+    paths = input_paths(directory)
+    check_inputs(paths['mbi_file'], paths['outcome_file'], paths['partner_file'])
+    sid = outcome_sids(read_outcome(paths['outcome_file']))
+    state_dir = os.path.join(directory, INCREMENTAL_STATE_SUBDIR) if INCREMENTAL_STATE_SUBDIR else None
+    days = current_partner_days(paths['partner_file'], sid, state_dir, PARTNER_CHUNKSIZE)
+    return daily_engagement_index(days, sid), sid
+
+def run_daily_engagement(directory, windows=None):
+    """Write output/daily_engagement.csv (daily_engagement_frame) for one cohort folder and, for
+       windows [(start_day, end_day), ...], output/window_seconds.csv (one row per outcome-list sid,
+       one days_<start>_<end> column per window). Returns the index."""
+    import pandas as pd
+    index, sid = cohort_engagement_index(directory)
+    output_dir = os.path.dirname(input_paths(directory)['output_file'])
+    os.makedirs(output_dir, exist_ok=True)
+    daily_file = os.path.join(output_dir, "daily_engagement.csv")
+    daily_engagement_frame(index).to_csv(daily_file, index=False)
+    print("Daily engagement written to:", daily_file)
+    if windows:
+        table = pd.DataFrame({'sid': sid})
+        for lo, hi in windows:
+            table[f'days_{lo}_{hi}'] = window_seconds(index, sid, lo, hi)
+        window_file = os.path.join(output_dir, "window_seconds.csv")
+        table.to_csv(window_file, index=False)
+        print("Window totals written to:", window_file)
+    return index
+
+# -------------------------
+# Command line
+# -------------------------
+def validate_inputs(directory):
+    """Check that a cohort folder's raw files exist, can be decoded and have the columns the pipeline
+       needs (input_problems; no pandas). Returns a list of problems (empty if OK)."""
+    paths = input_paths(directory)
+    return input_problems(expected_inputs(paths['mbi_file'], paths['outcome_file'], paths['partner_file']))
+
+def whole_days(text):
+    """int() of a day count given on the command line: digits only (ValueError otherwise)."""
+    text = text.strip()
+    if not (text.isascii() and text.isdigit()):
+        raise ValueError(f"{text!r} is not a whole number of days")
+    return int(text)
+
+def parse_window_edges(text):
+    """Parse --windows ('0,7,14,21,56') into window edges: whole days, at least two, strictly increasing."""
+    edges = [whole_days(day) for day in text.split(',')]
+    if len(edges) < 2:
+        raise ValueError("at least two edges (one window) are needed")
+    for lo, hi in zip(edges, edges[1:]):
+        if lo >= hi:
+            raise ValueError(f"edges must increase ({lo} is followed by {hi})")
+    return edges
+
+def day_windows(text):
+    """Parse --window-seconds ('A-B,C-D,...') into [(A, B), ...]; every window needs 0 <= A < B."""
+    windows = []
+    for window in text.split(','):
+        days = window.split('-')
+        if len(days) != 2:
+            raise ValueError(f"window {window.strip()!r} is not of the form A-B")
+        start, end = whole_days(days[0]), whole_days(days[1])
+        if start >= end:
+            raise ValueError(f"window {window.strip()!r} must end after it starts")
+        windows.append((start, end))
+    return windows
+
+def sweep_values(text, convert, what):
+    """Parse a comma-separated sweep grid axis (--sweep-caps with int, the percentages with float);
+       every value must convert and be a finite number > 0."""
+    values = []
+    for item in text.split(','):
+        try:
+            value = convert(item)
+        except ValueError:
+            raise ValueError(f"{item.strip()!r} is not {what}") from None
+        if not 0 < value < float('inf'):
+            raise ValueError(f"{item.strip()!r} must be a finite number greater than 0")
+        values.append(value)
+    return values
+
+def main(argv=None):
+    """Command line entry point; pandas/numpy are only imported once a report is actually built."""
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Adherence report for the MBI pediatric mTBI project (REDCap + partner-app exports).")
+    parser.add_argument('directories', nargs='*',
+                        help="cohort folder(s) holding raw/ (default: COHORT_DIRECTORIES, else this script's folder); "
+                             "several folders are run in parallel and also give a combined report")
+    parser.add_argument('--combined-output', help="combined report path for several folders "
+                                                  "(default: output/adherence_report_combined.csv next to this script)")
+    parser.add_argument('--windows', help="window edges in days since the first session, e.g. 0,7,14,21,56")
+    parser.add_argument('--duration-cap', type=int, help=f"per-session duration cap in seconds (default {DURATION_CAP})")
+    parser.add_argument('--mbi-threshold', type=float,
+                        help=f"overall MBI adherence threshold in seconds (default {seventypercent_mod1to4:g})")
+    parser.add_argument('--control-threshold', type=float,
+                        help=f"overall control adherence threshold in seconds (default {seventypercent_controllen:g})")
+    parser.add_argument('--mbi-weekly', type=float, help=f"weekly MBI threshold in seconds (default {avg_weekly:g})")
+    parser.add_argument('--control-weekly', type=float,
+                        help=f"weekly control threshold in seconds (default {avg_weekly_con:g})")
+    parser.add_argument('--chunksize', type=int, help="stream PartnerReport in chunks of this many rows")
+    parser.add_argument('--shards', type=int, help="fold one PartnerReport in this many parallel row ranges")
+    parser.add_argument('--workers', type=int, help="worker processes (default: number of CPUs)")
+    parser.add_argument('--input-threads', type=int,
+                        help=f"threads reading the raw inputs at once (default {INPUT_THREADS}; 1 = one after another)")
+    parser.add_argument('--no-incremental', action='store_true', help="ignore and do not write output/state")
+    parser.add_argument('--no-cache', action='store_true', help="always parse the raw CSVs")
+    parser.add_argument('--true-elapsed-snapshots', action='store_true',
+                        help="snapshot deltas as true elapsed seconds instead of the legacy .seconds wrap-around")
+    parser.add_argument('--formats', help="comma-separated report formats: legacy, tidy, parquet, feather "
+                                          "(default: legacy)")
+    parser.add_argument('--no-run-log', action='store_true', help="do not write output/run_log.json/.csv")
+    parser.add_argument('--profile', choices=['cprofile', 'tracemalloc'],
+                        help="profile the run and write the top hot spots to output/profile_top.txt")
+    parser.add_argument('--validate-only', action='store_true', help="check the input files and exit")
+    parser.add_argument('--coercion-report', action='store_true',
+                        help="also write output/coercion_report.csv (blank/invalid/substituted cells per input column)")
+    parser.add_argument('--daily-engagement', action='store_true',
+                        help="write the per-day engagement time series (output/daily_engagement.csv) instead of the report")
+    parser.add_argument('--window-seconds',
+                        help="engagement seconds per participant for day windows since the first session, e.g. "
+                             "0-7,10-30 (output/window_seconds.csv), implies --daily-engagement")
+    parser.add_argument('--sweep', action='store_true',
+                        help="write the threshold sensitivity sweep (output/threshold_sweep_*.csv) instead of the report "
+                             "(its grid replaces --duration-cap and the threshold options)")
+    parser.add_argument('--sweep-caps', help=f"duration caps of the sweep in seconds (default {SWEEP_CAPS}), "
+                                             "implies --sweep")
+    parser.add_argument('--sweep-percents', help=f"adherence percentages of the sweep (default {SWEEP_PERCENTS}), "
+                                                 "implies --sweep")
+    parser.add_argument('--sweep-weekly-percents', help="separate weekly percentages (default: the --sweep-percents "
+                                                        "value of each cell), implies --sweep")
+    args = parser.parse_args(argv)
+    try:
+        edges = None if args.windows is None else parse_window_edges(args.windows)
+    except ValueError as e:
+        parser.error(f"--windows: {e}")
+    sweep = []
+    for option, value, convert, what in [('--sweep-caps', args.sweep_caps, int, "a whole number of seconds"),
+                                         ('--sweep-percents', args.sweep_percents, float, "a number"),
+                                         ('--sweep-weekly-percents', args.sweep_weekly_percents, float, "a number")]:
+        try:
+            sweep.append(None if value is None else sweep_values(value, convert, what))
+        except ValueError as e:
+            parser.error(f"{option}: {e}")
+    # the sweep replaces the cap and the thresholds by its own grid
+    fixed = [option for option, value in [('--duration-cap', args.duration_cap),
+                                          ('--mbi-threshold', args.mbi_threshold),
+                                          ('--control-threshold', args.control_threshold),
+                                          ('--mbi-weekly', args.mbi_weekly), ('--control-weekly', args.control_weekly)]
+             if value is not None]
+    if fixed and (args.sweep or any(v is not None for v in sweep)):
+        parser.error(f"{', '.join(fixed)} cannot be combined with the threshold sweep; "
+                     "give the grid with --sweep-caps / --sweep-percents / --sweep-weekly-percents")
+
+    settings = current_settings()
+    for name, value in [('WINDOW_EDGES_DAYS', edges),
+                        ('DURATION_CAP', args.duration_cap), ('seventypercent_mod1to4', args.mbi_threshold),
+                        ('seventypercent_controllen', args.control_threshold), ('avg_weekly', args.mbi_weekly),
+                        ('avg_weekly_con', args.control_weekly), ('PARTNER_CHUNKSIZE', args.chunksize),
+                        ('INPUT_THREADS', args.input_threads)]:
+        if value is not None:
+            settings[name] = value
+    if args.no_incremental:
+        settings['INCREMENTAL_STATE_SUBDIR'] = None
+    if args.no_cache:
+        settings['CSV_CACHE_DIRNAME'] = None
+    if args.true_elapsed_snapshots:
+        settings['SNAPSHOT_LEGACY_SECONDS'] = False
+    if args.formats:
+        settings['REPORT_FORMATS'] = [fmt.strip() for fmt in args.formats.split(',') if fmt.strip()]
+    if args.no_run_log:
+        settings['RUN_LOG_NAME'] = None
+    if args.profile:
+        settings['PROFILE_MODE'] = args.profile
+    if args.coercion_report:
+        settings['COERCION_REPORT'] = True
+    apply_settings(settings)
+    try:
+        check_report_formats()
+    except (ValueError, ImportError) as e:
+        parser.error(str(e))
+    try:
+        windows = None if args.window_seconds is None else day_windows(args.window_seconds)
+    except ValueError as e:
+        parser.error(f"--window-seconds: {e}")
+
+    directories = args.directories or COHORT_DIRECTORIES or [directory]
+    # a cohort with input problems is reported and skipped; the other cohorts still run
+    bad = []
+    for d in directories:
+        problems = validate_inputs(d)
+        for problem in problems:
+            print("Input problem:", problem)
+        if problems:
+            bad.append(d)
+    if args.validate_only:
+        good = [d for d in directories if d not in bad]
+        if good:
+            print("Inputs OK:", ", ".join(good))
+        return 1 if bad else 0
+    if len(directories) == 1 and bad:
+        return 1
+
+    if args.daily_engagement or windows:
+        for d in directories:
+            if d not in bad:
+                run_daily_engagement(d, windows)
+        return 1 if bad else 0
+    if args.sweep or any(v is not None for v in sweep):
+        for d in directories:
+            if d not in bad:
+                run_threshold_sweep(d, *sweep)
+        return 1 if bad else 0
+
+    if len(directories) > 1:
+        combined = args.combined_output or os.path.join(directory, "output", "adherence_report_combined.csv")
+        _, failures = run_cohorts(directories, combined, args.workers)
+        return 1 if failures else 0
+    run_adherence_report(directories[0], args.shards or PARTNER_SHARDS, args.workers or MAX_WORKERS)
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,361 @@
+"""
+Benchmark suite for adherence_report.py.
+
+Builds synthetic cohorts (REDCap export, outcome list, PartnerReport) at several sizes, times the
+pipeline stages and the full run, records wall time and peak memory per stage to a JSON results
+file, and checks that the report is byte-identical to the golden output recorded in
+benchmark/golden.json.
+
+    python benchmark_adherence_report.py                      # full grid, compare to golden
+    python benchmark_adherence_report.py --sessions 100 10000 --participants 10 1000
+    python benchmark_adherence_report.py --write-golden       # record goldens from the current code
+    python benchmark_adherence_report.py --compare benchmark/results/OLD.json
+"""
+
+import os
+import io
+import json
+import shutil
+import time
+import hashlib
+import platform
+import argparse
+import tempfile
+import tracemalloc
+import statistics
+import threading
+import subprocess
+import contextlib
+
+import numpy as np
+import pandas as pd
+
+import adherence_report as ar
+
+# -------------------------
+# Configuration
+# -------------------------
+HERE = os.path.dirname(os.path.abspath(__file__))
+BENCHMARK_DIR = os.path.join(HERE, "benchmark")
+GOLDEN_FILE = os.path.join(BENCHMARK_DIR, "golden.json")
+RESULTS_DIR = os.path.join(BENCHMARK_DIR, "results")
+
+SESSION_SIZES = [100, 10_000, 1_000_000]
+PARTICIPANT_SIZES = [10, 1_000, 10_000]
+SEED = 0
+# cases with at least this many sessions are timed once whatever --repeat says
+LARGE_CASE_SESSIONS = 1_000_000
+
+PARTNER_HEADER = ["sid", "session_stage", "session_number", "session_start_date", "session_duration",
+                  "session_length", "snapshot_start_pre", "snapshot_finish_pre", "snapshot_start_post",
+                  "snapshot_finish_post", "group", "heartrate_pre", "breathrate_pre", "o2level_pre",
+                  "hrv_low_freq_sum_pre", "hrv_high_freq_sum_pre", "heartrate_post", "breathrate_post",
+                  "o2level_post", "hrv_low_freq_sum_post", "hrv_high_freq_sum_post", "session_type"]
+
+# -------------------------
+# Synthetic cohorts
+# -------------------------
+def case_name(n_sessions, n_participants, seed):
+    return f"s{n_sessions}_p{n_participants}_seed{seed}"
+
+def make_cohort(root, n_sessions, n_participants, seed=SEED):
+    """Write raw/ inputs for one synthetic cohort under root. The data mimics the real exports,
+       including the messy cells the script has to cope with (blank/invalid dates and durations,
+       mixed date formats, missing or out-of-order snapshots, several UTC offsets, unknown sids)."""
+    rng = np.random.default_rng(seed)
+    raw = os.path.join(root, "raw")
+    os.makedirs(raw, exist_ok=True)
+    os.makedirs(os.path.join(root, "output"), exist_ok=True)
+    sids = np.array([str(100000 + i) for i in range(n_participants)])
+
+    # outcome list: most participants, plus one id that is not in REDCap
+    outcome = np.append(sids[rng.random(n_participants) < 0.9], "999999")
+    pd.DataFrame({"record_id": outcome}).to_csv(os.path.join(raw, "Outcome_complete.csv"), index=False)
+
+    randomization = rng.choice(np.array(["0", "0", "1", "1", ""]), n_participants)
+    day1 = pd.DataFrame({"record_id": sids, "redcap_event_name": "day_1_arm_1", "randomization": randomization,
+                         "mri_comp_2": rng.choice(np.array(["1", "0", ""]), n_participants),
+                         "week_4_8_questionnaires_complete": "", "week_4_debriefing_complete": ""})
+    has_week4 = rng.random(n_participants) < 0.8
+    n_week4 = int(has_week4.sum())
+    week4 = pd.DataFrame({"record_id": sids[has_week4], "redcap_event_name": "week_4_arm_1",
+                          "randomization": randomization[has_week4], "mri_comp_2": "",
+                          "week_4_8_questionnaires_complete": rng.choice(np.array(["1", "0", ""]), n_week4),
+                          "week_4_debriefing_complete": rng.choice(np.array(["1", "0", ""]), n_week4)})
+    mbi = pd.concat([day1, week4], ignore_index=True)
+    mbi.to_csv(os.path.join(raw, "MBIProjectPhase2.csv"), index=False, encoding="utf-8-sig")
+
+    # PartnerReport: each session ~70 days after its participant's first day, 1% unknown sids
+    n = n_sessions
+    sid_pos = rng.integers(0, n_participants, n)
+    sid = pd.Series(sids[sid_pos]).where(rng.random(n) >= 0.01, "777777")
+    first_day = np.datetime64("2024-01-01") + rng.integers(0, 300, n_participants).astype("timedelta64[D]")
+    day = first_day[sid_pos] + rng.integers(0, 70, n).astype("timedelta64[D]")
+    iso_day = pd.Series(np.datetime_as_string(day, unit="D"))
+    fmt = rng.random(n)
+    start_date = iso_day.where(fmt >= 0.25, iso_day.str.replace("-", "/", regex=False))
+    start_date = start_date.where((fmt < 0.25) | (fmt >= 0.30), iso_day + " 08:30:00")
+    start_date = start_date.where(fmt >= 0.05, "notadate").where(fmt >= 0.03, "")
+
+    duration = pd.Series(rng.integers(0, 5000, n).astype(str))
+    bad = rng.random(n)
+    duration = duration.where(bad >= 0.06, "").where((bad < 0.06) | (bad >= 0.08), "abc")
+    duration = duration.where((bad < 0.08) | (bad >= 0.10), "12.5")
+
+    def snapshots():
+        offsets = rng.choice(np.array(["+00:00", "-04:00", "-06:00"]), n)
+        start = day.astype("datetime64[s]") + rng.integers(0, 86400, n).astype("timedelta64[s]")
+        kind = rng.random(n)
+        elapsed = np.where(kind < 0.8, rng.integers(0, 400, n),
+                           np.where(kind < 0.9, -rng.integers(1, 300, n), rng.integers(80000, 90000, n)))
+        finish = start + elapsed.astype("timedelta64[s]")
+        missing = rng.random(n) < 0.05
+        start_s = pd.Series(np.datetime_as_string(start, unit="s")) + offsets
+        finish_s = pd.Series(np.datetime_as_string(finish, unit="s")) + offsets
+        return start_s.where(~missing, ""), finish_s.where(~missing, "")
+
+    def vitals(lo, hi):
+        values = pd.Series(rng.integers(lo, hi, n).astype(str))
+        return values.where(rng.random(n) >= 0.05, "")
+
+    start_pre, finish_pre = snapshots()
+    start_post, finish_post = snapshots()
+    partner = pd.DataFrame({
+        "sid": sid,
+        "session_stage": pd.Series(rng.integers(1, 31, n)).map("S{:02d}".format).where(rng.random(n) >= 0.03, ""),
+        "session_number": np.arange(1, n + 1),
+        "session_start_date": start_date,
+        "session_duration": duration,
+        "session_length": duration,
+        "snapshot_start_pre": start_pre, "snapshot_finish_pre": finish_pre,
+        "snapshot_start_post": start_post, "snapshot_finish_post": finish_post,
+        "group": rng.choice(np.array(["A", "B"]), n),
+        "heartrate_pre": vitals(50, 100), "breathrate_pre": vitals(8, 20), "o2level_pre": vitals(90, 100),
+        "hrv_low_freq_sum_pre": vitals(50, 150), "hrv_high_freq_sum_pre": vitals(20, 80),
+        "heartrate_post": vitals(50, 100), "breathrate_post": vitals(8, 20), "o2level_post": vitals(90, 100),
+        "hrv_low_freq_sum_post": vitals(50, 150), "hrv_high_freq_sum_post": vitals(20, 80),
+        "session_type": rng.choice(np.array(["Journey", "Standalone", "", "JourneyStandalone"]), n),
+    }, columns=PARTNER_HEADER)
+    partner.to_csv(os.path.join(raw, "PartnerReport.csv"), index=False)
+    return root
+
+# -------------------------
+# Measurement
+# -------------------------
+def current_rss():
+    """Resident set size of this process in bytes (psutil if installed, /proc on Linux), else None."""
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+@contextlib.contextmanager
+def rss_peak(interval=0.005):
+    """Sample the RSS in a background thread while the block runs. The yielded dict gets 'growth':
+       the peak RSS above the value at entry in bytes (None when RSS cannot be read). This also
+       covers Arrow string buffers, which tracemalloc does not see."""
+    state = {"start": current_rss(), "growth": None}
+    if state["start"] is None:
+        yield state
+        return
+    state["peak"] = state["start"]
+    stop = threading.Event()
+
+    def sample():
+        while not stop.wait(interval):
+            state["peak"] = max(state["peak"], current_rss())
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    try:
+        yield state
+    finally:
+        stop.set()
+        sampler.join()
+        state["growth"] = max(state["peak"], current_rss()) - state["start"]
+
+def measure(fn, repeat):
+    """Run fn repeat times for wall time (RSS sampled during the last run), then once more under
+       tracemalloc for the peak of the Python/numpy allocations it makes. Returns (stats, last result)."""
+    times = []
+    for i in range(repeat):
+        with rss_peak() if i == repeat - 1 else contextlib.nullcontext({}) as rss:
+            t0 = time.perf_counter()
+            fn()
+            times.append(time.perf_counter() - t0)
+    tracemalloc.start()
+    try:
+        result = fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    stats = {"seconds_min": round(min(times), 6), "seconds_median": round(statistics.median(times), 6),
+             "peak_mib": round(peak / 2**20, 3),
+             "peak_rss_growth_mib": None if rss.get("growth") is None else round(rss["growth"] / 2**20, 3)}
+    return stats, result
+
+def run_pipeline(case_dir):
+    """Full run of one cohort folder; returns the report bytes."""
+    output_file = ar.input_paths(case_dir)["output_file"]
+    if os.path.exists(output_file):
+        os.remove(output_file)
+    with contextlib.redirect_stdout(io.StringIO()):
+        ar.run_adherence_report(case_dir)
+    with open(output_file, "rb") as f:
+        return f.read()
+
+def benchmark_case(case_dir, repeat):
+    """Time each stage on one cohort folder. Stages run on the output of the previous one, so the
+       numbers isolate each step; 'pipeline' is the whole script end to end."""
+    paths = ar.input_paths(case_dir)
+    stages = {}
+    stages["read_partner"], raw = measure(lambda: ar.safe_read_csv(paths["partner_file"]), repeat)
+    stages["normalize_dates"], _ = measure(lambda: ar.normalize_session_dates(raw["session_start_date"]), repeat)
+    stages["prepare_partner"], partner = measure(lambda: ar.prepare_partner(raw.copy()), repeat)
+    stages["delta_snap"], _ = measure(lambda: (ar.compute_delta_snap(partner, "snapshot_start_pre", "snapshot_finish_pre"),
+                                               ar.compute_delta_snap(partner, "snapshot_start_post", "snapshot_finish_post")),
+                                      repeat)
+    inputs = ar.load_inputs(paths["mbi_file"], paths["outcome_file"], paths["partner_file"])
+    sid = inputs["sid"]
+    stages["duration_totals"], days = measure(lambda: ar.fold_partner_days([ar.session_row_metrics(partner)], sid), repeat)
+    stages["weekly_durations"], totals = measure(lambda: ar.finalize_partner_totals(days, sid), repeat)
+    stages["metrics_report"], _ = measure(lambda: ar.build_report(ar.compute_metrics(inputs, totals)), repeat)
+    stages["pipeline"], report = measure(lambda: run_pipeline(case_dir), repeat)
+    # in-memory size of PartnerReport as read (all strings) and as prepared (typed columns)
+    frames = {"strings_mib": frame_mib(raw), "typed_mib": frame_mib(partner)}
+    return stages, frames, report
+
+def frame_mib(df):
+    return round(df.memory_usage(deep=True).sum() / 2**20, 3)
+
+# -------------------------
+# Results
+# -------------------------
+def git_revision():
+    """(commit, dirty) of the working tree, or (None, None) outside git."""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=HERE, capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--", "."], cwd=HERE, capture_output=True,
+                                    text=True, check=True).stdout.strip())
+        return commit, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+def load_json(path, default):
+    if not os.path.exists(path):
+        return default
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+def save_json(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+def compare_results(old, new):
+    """Print stage time and peak memory ratios new/old for the cases both runs have."""
+    old_cases = {c["case"]: c for c in old["cases"]}
+    print(f"\nCompared with {str(old.get('commit'))[:10]} (ratio new/old, < 1 is better):")
+    for case in new["cases"]:
+        before = old_cases.get(case["case"])
+        if before is None:
+            continue
+        print(f"  {case['case']}")
+        for stage, stats in case["stages"].items():
+            prev = before["stages"].get(stage)
+            if not prev:
+                continue
+            t_ratio = stats["seconds_min"] / prev["seconds_min"] if prev["seconds_min"] else float("nan")
+            m_ratio = stats["peak_mib"] / prev["peak_mib"] if prev["peak_mib"] else float("nan")
+            print(f"    {stage:<18} time x{t_ratio:6.2f}   peak memory x{m_ratio:6.2f}")
+
+# -------------------------
+# Main
+# -------------------------
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark adherence_report.py and check its output against goldens.")
+    parser.add_argument("--sessions", type=int, nargs="+", default=SESSION_SIZES, help="PartnerReport sizes (rows)")
+    parser.add_argument("--participants", type=int, nargs="+", default=PARTICIPANT_SIZES, help="participant counts")
+    parser.add_argument("--seed", type=int, default=SEED)
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per stage (minimum and median are kept; "
+                                                              f"1 from {LARGE_CASE_SESSIONS} sessions)")
+    parser.add_argument("--workdir", help="keep the generated cohorts here (default: a temporary folder)")
+    parser.add_argument("--output", help="results JSON (default: benchmark/results/<time>_<commit>.json)")
+    parser.add_argument("--compare", help="earlier results JSON to compare against")
+    parser.add_argument("--write-golden", action="store_true", help="record the current reports as goldens")
+    parser.add_argument("--golden-only", action="store_true", help="only run the pipeline once per case and check "
+                                                                    "(or with --write-golden record) the report")
+    args = parser.parse_args(argv)
+
+    # measure the cold path: no parsed-CSV cache, no incremental state
+    ar.apply_settings({"CSV_CACHE_DIRNAME": None, "INCREMENTAL_STATE_SUBDIR": None})
+    commit, dirty = git_revision()
+    results = {"commit": commit, "dirty": dirty, "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+               "python": platform.python_version(), "pandas": pd.__version__, "numpy": np.__version__,
+               "platform": platform.platform(), "repeat": args.repeat, "cases": []}
+    golden = load_json(GOLDEN_FILE, {})
+    mismatches = []
+
+    with contextlib.ExitStack() as stack:
+        workdir = args.workdir or stack.enter_context(tempfile.TemporaryDirectory(prefix="adherence_bench_"))
+        cases = [("fixture", HERE, None, None)]
+        cases += [(case_name(s, p, args.seed), os.path.join(workdir, case_name(s, p, args.seed)), s, p)
+                  for s in args.sessions for p in args.participants]
+        for name, case_dir, n_sessions, n_participants in cases:
+            if n_sessions is not None and not os.path.exists(os.path.join(case_dir, "raw", "PartnerReport.csv")):
+                make_cohort(case_dir, n_sessions, n_participants, args.seed)
+            if name == "fixture":
+                # the checked-in raw/ folder: only the report is checked, its output/ is left untouched
+                with tempfile.TemporaryDirectory(prefix="adherence_fixture_") as tmp:
+                    shutil.copytree(os.path.join(HERE, "raw"), os.path.join(tmp, "raw"))
+                    stages, frames, report = {}, {}, run_pipeline(tmp)
+            elif args.golden_only:
+                stages, frames, report = {}, {}, run_pipeline(case_dir)
+            else:
+                print(f"Benchmarking {name} ...", flush=True)
+                repeat = 1 if n_sessions >= LARGE_CASE_SESSIONS else args.repeat
+                stages, frames, report = benchmark_case(case_dir, repeat)
+            digest = hashlib.sha256(report).hexdigest()
+            if args.write_golden:
+                golden[name] = {"sha256": digest, "bytes": len(report)}
+                status = "written"
+            elif name not in golden:
+                status = "missing"
+            else:
+                status = "match" if golden[name]["sha256"] == digest else "MISMATCH"
+                if status == "MISMATCH":
+                    mismatches.append(name)
+            results["cases"].append({"case": name, "sessions": n_sessions, "participants": n_participants,
+                                     "seed": args.seed if n_sessions is not None else None,
+                                     "report_sha256": digest, "golden": status, "stages": stages,
+                                     "partner_frame": frames})
+            pipeline = stages.get("pipeline")
+            timing = f"{pipeline['seconds_min']:.3f}s, peak {pipeline['peak_mib']:.1f} MiB" if pipeline else "report only"
+            if frames:
+                timing += f", PartnerReport {frames['strings_mib']:.1f} -> {frames['typed_mib']:.1f} MiB in memory"
+            print(f"  {name}: {timing}, golden {status}", flush=True)
+
+    if args.write_golden:
+        save_json(GOLDEN_FILE, golden)
+        print("Golden outputs written to:", GOLDEN_FILE)
+    output = args.output or os.path.join(
+        RESULTS_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}_{(commit or 'nogit')[:10]}{'-dirty' if dirty else ''}.json")
+    save_json(output, results)
+    print("Benchmark results written to:", output)
+    if args.compare:
+        compare_results(load_json(args.compare, {"cases": []}), results)
+    if mismatches:
+        print("Report differs from the golden output for:", ", ".join(mismatches))
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,174 @@
+"""
+Regression tests for adherence_report.py on small hand-written cohorts.
+
+    python -m pytest test_adherence_report.py
+"""
+
+import os
+import csv
+
+import pandas as pd
+import pytest
+
+import adherence_report as ar
+
+PARTNER_HEADER = ["sid", "session_stage", "session_start_date", "session_duration", "snapshot_start_pre",
+                  "snapshot_finish_pre", "snapshot_start_post", "snapshot_finish_post", "session_type"]
+
+# -------------------------
+# Helpers
+# -------------------------
+def write_csv(path, header, rows):
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(rows)
+
+def make_cohort(root, sids, partner_rows):
+    """raw/ inputs for one cohort: every sid in REDCap (day 1 and week 4, alternating arms) and in the
+       outcome list, and partner_rows (lists in PARTNER_HEADER order) as PartnerReport."""
+    raw = os.path.join(root, "raw")
+    os.makedirs(raw)
+    os.makedirs(os.path.join(root, "output"))
+    mbi = []
+    for k, sid in enumerate(sids):
+        mbi.append([sid, "day_1_arm_1", str(k % 2), "1", "", ""])
+        mbi.append([sid, "week_4_arm_1", str(k % 2), "", "1", "1"])
+    write_csv(os.path.join(raw, "MBIProjectPhase2.csv"),
+              ["record_id", "redcap_event_name", "randomization", "mri_comp_2",
+               "week_4_8_questionnaires_complete", "week_4_debriefing_complete"], mbi)
+    write_csv(os.path.join(raw, "Outcome_complete.csv"), ["record_id"], [[sid] for sid in sids])
+    write_csv(os.path.join(raw, "PartnerReport.csv"), PARTNER_HEADER, partner_rows)
+    return str(root)
+
+def session(sid, start_date, duration, snap_pre=("", ""), snap_post=("", ""), stage="S01", kind="Journey"):
+    return [sid, stage, start_date, duration, *snap_pre, *snap_post, kind]
+
+@pytest.fixture(autouse=True)
+def settings():
+    """Every test starts from the module defaults, without a CSV cache or incremental state."""
+    saved = ar.current_settings()
+    ar.apply_settings({"CSV_CACHE_DIRNAME": None, "INCREMENTAL_STATE_SUBDIR": None, "RUN_LOG_NAME": None})
+    yield
+    ar.apply_settings(saved)
+
+def by_sid(metrics):
+    return metrics.set_index("sid")
+
+# -------------------------
+# Undated sessions
+# -------------------------
+def test_undated_sessions_add_no_duration(tmp_path):
+    # 1002 has no parseable session date at all; its snapshots still count, on the sentinel day
+    rows = [session("1001", "2024-01-01", "1200"),
+            session("1001", "2024-01-09", "4000"),
+            session("1001", "", "900"),
+            session("1002", "", "1500", snap_pre=("2024-01-01T12:00:00+00:00", "2024-01-01T12:02:00+00:00")),
+            session("1002", "notadate", "700", stage="S04")]
+    metrics = by_sid(ar.run_adherence_report(make_cohort(tmp_path, ["1001", "1002"], rows)))
+
+    assert metrics.loc["1001", "session_duration_sum"] == 1200 + 3600
+    assert metrics.loc["1001", "sessionduration_wk1"] == 1200
+    undated = metrics.loc["1002"]
+    assert undated["session_duration_sum"] == 0
+    assert undated["delta_snap_pre"] == 120
+    assert undated["session_duration_snapsincluded"] == 120
+    assert undated["sessionduration_wk1"] == 120
+    assert undated["sessiontype_journey_totalcount"] == 2
+    assert undated["session_stage_max"] == "04"
+
+def test_undated_sessions_streamed(tmp_path):
+    rows = [session("1002", "", "1500"), session("1001", "2024-01-01", "1200"),
+            session("1002", "notadate", "700"), session("1001", "", "900")]
+    directory = make_cohort(tmp_path, ["1001", "1002"], rows)
+    whole = ar.run_adherence_report(directory)
+    ar.apply_settings({"PARTNER_CHUNKSIZE": 1})
+    streamed = ar.run_adherence_report(directory)
+    assert streamed.equals(whole)
+    assert by_sid(streamed).loc["1002", "session_duration_sum"] == 0
+
+# -------------------------
+# Multi-cohort runs
+# -------------------------
+def test_combined_report_keeps_the_cohort(tmp_path):
+    # both cohorts use sids 1001 and 1002, with different sessions
+    site_a = make_cohort(tmp_path / "site_a", ["1001", "1002"],
+                         [session("1001", "2024-01-01", "1200"), session("1002", "2024-02-01", "300")])
+    site_b = make_cohort(tmp_path / "site_b", ["1002", "1001"],
+                         [session("1001", "2024-03-01", "2500"), session("1002", "2024-03-02", "100")])
+    ar.apply_settings({"REPORT_FORMATS": ["legacy", "tidy", "parquet", "feather"]})
+    combined_file = str(tmp_path / "combined.csv")
+    results, failures = ar.run_cohorts([site_a, site_b], combined_file, max_workers=2)
+    assert failures == {}
+
+    files = ar.report_files(combined_file)
+    tidy = pd.read_csv(files["tidy"], dtype={"sid": str})
+    for combined in [tidy, pd.read_parquet(files["parquet"]), pd.read_feather(files["feather"])]:
+        assert list(combined.columns[:2]) == ["cohort", "sid"]
+        assert list(zip(combined["cohort"], combined["sid"])) == [(site_a, "1001"), (site_a, "1002"),
+                                                                   (site_b, "1002"), (site_b, "1001")]
+        assert combined["session_duration_sum"].tolist() == [1200, 300, 100, 2500]
+    with open(files["legacy"], newline="") as f:
+        legacy = list(csv.reader(f))
+    assert legacy[0][3:5] == ["cohort", "sid"]
+    assert legacy[1][3:5] == [site_a, "1001"]
+
+# -------------------------
+# Coercion report
+# -------------------------
+def test_coercion_report_streamed_and_sharded(tmp_path):
+    rows = [session("1001", "2024-01-01", "1200"), session("1001", "notadate", "abc"),
+            session("1002", "", ""), session("1002", "2024-01-03", "12.5", stage=""),
+            session("1001", "2024-01-02", "x", snap_pre=("2024-01-02T12:00:00+00:00", ""))]
+    directory = make_cohort(tmp_path, ["1001", "1002"], rows)
+    ar.apply_settings({"COERCION_REPORT": True})
+    coercion_file = os.path.join(directory, "output", "coercion_report.csv")
+    ar.run_adherence_report(directory)
+    whole = pd.read_csv(coercion_file, keep_default_na=False).set_index("column")
+    assert whole.loc["session_duration", ["blank", "invalid", "substituted"]].tolist() == [1, 3, 4]
+    assert whole.loc["session_duration", "sample_rows"] == "2 3 4 5"
+    assert whole.loc["session_duration", "sample_values"] == "abc|12.5|x"
+    assert whole.loc["session_start_date", ["blank", "invalid", "substituted"]].tolist() == [1, 1, 2]
+    assert whole.loc["delta_snap_pre", "substituted"] == 1
+
+    ar.apply_settings({"PARTNER_CHUNKSIZE": 2})
+    ar.run_adherence_report(directory, shards=2)
+    assert pd.read_csv(coercion_file, keep_default_na=False).set_index("column").equals(whole)
+
+# -------------------------
+# Command line
+# -------------------------
+@pytest.mark.parametrize("value", ["", "7-0", "5-5", "0-7,x", "-1-5", "3", "0-7,", "0-7-9"])
+def test_bad_window_seconds_are_rejected(tmp_path, capsys, value):
+    with pytest.raises(SystemExit) as exit_info:
+        ar.main([str(tmp_path), "--window-seconds=" + value])
+    assert exit_info.value.code == 2
+    assert "--window-seconds:" in capsys.readouterr().err
+
+def test_day_windows():
+    assert ar.day_windows("0-7, 10-30") == [(0, 7), (10, 30)]
+
+@pytest.mark.parametrize("value", ["", "7", "0,7,7,56", "0,14,7", "0,x", "0,-7", "0,7,"])
+def test_bad_windows_are_rejected(tmp_path, capsys, value):
+    with pytest.raises(SystemExit) as exit_info:
+        ar.main([str(tmp_path), "--windows=" + value])
+    assert exit_info.value.code == 2
+    assert "--windows:" in capsys.readouterr().err
+
+def test_window_edges():
+    assert ar.parse_window_edges("0, 7,14,21,56") == [0, 7, 14, 21, 56]
+
+@pytest.mark.parametrize("args", [["--sweep-caps=1800,x"], ["--sweep-caps=0"], ["--sweep-caps="],
+                                  ["--sweep-percents=0.7,nan"], ["--sweep-percents=-0.5"],
+                                  ["--sweep-weekly-percents=inf"], ["--sweep", "--duration-cap=3000"],
+                                  ["--sweep-percents=0.7", "--mbi-threshold=5000"],
+                                  ["--sweep-caps=1800", "--control-weekly=100"]])
+def test_bad_sweep_options_are_rejected(tmp_path, capsys, args):
+    with pytest.raises(SystemExit) as exit_info:
+        ar.main([str(tmp_path)] + args)
+    assert exit_info.value.code == 2
+    assert "error:" in capsys.readouterr().err
+
+def test_sweep_values():
+    assert ar.sweep_values("1800, 3600", int, "seconds") == [1800, 3600]
+    assert ar.sweep_values("0.5,0.7", float, "a number") == [0.5, 0.7]
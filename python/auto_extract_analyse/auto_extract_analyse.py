@@ -2,10 +2,213 @@
 # Takes input table, identifies relevant variables, builds a basic SQL script
 
 import pandas as pd
+import numpy as np
 import os
+import csv
+import base64
+import time
+import json
+import sqlite3
+import tempfile
+import itertools
 
-print("Welcome to the Automated Extract and Analyse Tool. Make sure you have SQL and R.\n")
+# Datasets are opened lazily: only the header and the first SCHEMA_SAMPLE_ROWS rows (for dtype
+# inference) are read up front; the rows are streamed in chunks when a query is run.
+SCHEMA_SAMPLE_ROWS = 1000
+# Schema catalog kept next to the CSVs (raw/.schema_catalog.json), one entry per CSV keyed by its path and
+# checked against size + mtime: column names and dtypes answer the prompts without opening the file.
+# --refresh-catalog profiles new/changed CSVs (row count, dtypes, null fractions, distinct-count
+# estimates from a HyperLogLog sketch with 2**HLL_PRECISION registers). None disables the catalog.
+SCHEMA_CATALOG_NAME = ".schema_catalog.json"
+HLL_PRECISION = 12
+# Local execution of the generated query: the needed columns of each CSV are bulk-loaded into SQLite
+# SQLITE_LOAD_CHUNK_ROWS rows at a time, the join columns are indexed and the joined table is written to
+# output/joined_result.csv. None keeps the database in memory; a file name (in output/) keeps it on disk
+# for tables larger than memory.
+SQLITE_DATABASE = None
+SQLITE_LOAD_CHUNK_ROWS = 100000
+# Streaming hash join (no database, tables larger than memory): a joined table of at most JOIN_MEMORY_ROWS
+# rows is hashed in memory and the base rows stream through it JOIN_CHUNK_ROWS at a time. Larger tables
+# are hash-partitioned on the join key into JOIN_PARTITIONS spill files per side (in JOIN_SPILL_DIR, None =
+# system temp folder) and joined partition by partition; each partition of the joined table must fit.
+JOIN_MEMORY_ROWS = 2_000_000
+JOIN_CHUNK_ROWS = 200_000
+JOIN_PARTITIONS = 64
+JOIN_SPILL_DIR = None
+# engines that can execute a query locally
+ENGINES = ["sqlite", "stream"]
+# Join-key profiling before a query is emitted: both key columns are streamed once into HyperLogLog sketches
+# (kept in the schema catalog while the CSV is unchanged) to estimate key uniqueness, overlap and the
+# LEFT JOIN row count. Joins estimated to grow past FANOUT_FLAG_RATIO times the base table are flagged.
+JOIN_PROFILE = True
+FANOUT_FLAG_RATIO = 10
 
+# raw/ and output/ next to this script
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+RAW_DIR = os.path.join(BASE_DIR, "raw")
+OUTPUT_DIR = os.path.join(BASE_DIR, "output")
+
+
+# -------------------------
+# Schema catalog (persistent, per raw folder)
+# -------------------------
+def catalog_path(filepath):
+    """The catalog file of the folder holding the CSV filepath."""
+    return os.path.join(os.path.dirname(os.path.abspath(filepath)), SCHEMA_CATALOG_NAME)
+
+def load_catalog(path):
+    """{absolute CSV path: entry} of a catalog file (empty if there is none or it is damaged)."""
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except ValueError:
+        return {}
+
+def write_catalog(path, catalog):
+    """Replace a catalog file atomically."""
+    with open(path + ".tmp", "w") as f:
+        json.dump(catalog, f, indent=1)
+    os.replace(path + ".tmp", path)
+
+def save_catalog_entry(filepath, entry):
+    """Store the entry of one CSV in the catalog next to it."""
+    path = catalog_path(filepath)
+    catalog = load_catalog(path)
+    catalog[os.path.abspath(filepath)] = entry
+    write_catalog(path, catalog)
+
+def catalog_entry(filepath, catalog=None):
+    """The catalog entry of a CSV if it matches the file's current size and mtime, else None.
+    Raises FileNotFoundError if the CSV does not exist."""
+    source = os.path.abspath(filepath)
+    stat = os.stat(source)
+    if not SCHEMA_CATALOG_NAME:
+        return None
+    entry = (load_catalog(catalog_path(source)) if catalog is None else catalog).get(source)
+    if entry and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+        return entry
+    return None
+
+def hll_registers(values, precision=None):
+    """HyperLogLog registers (uint8, 2**precision of them) of the non-null values of a Series."""
+    p = precision or HLL_PRECISION
+    hashes = pd.util.hash_pandas_object(values.dropna(), index=False).to_numpy()
+    index = (hashes >> np.uint64(64 - p)).astype(np.int64)
+    rest = (hashes << np.uint64(p)) | np.uint64(1 << (p - 1))  # guard bit: rank <= 64 - p + 1
+    bits = np.zeros(len(rest), dtype=np.int64)
+    for shift in (32, 16, 8, 4, 2, 1):  # exact bit length of the 64-bit values
+        big = rest >= (np.uint64(1) << np.uint64(shift))
+        rest = np.where(big, rest >> np.uint64(shift), rest)
+        bits += np.where(big, shift, 0)
+    rank = 64 - bits  # leading zeros + 1
+    registers = np.zeros(1 << p, dtype=np.uint8)
+    np.maximum.at(registers, index, rank.astype(np.uint8))
+    return registers
+
+def hll_estimate(registers):
+    """Distinct-count estimate of HyperLogLog registers (with the small-range correction)."""
+    m = len(registers)
+    estimate = 0.7213 / (1 + 1.079 / m) * m * m / np.sum(np.ldexp(1.0, -registers.astype(np.int64)))
+    zeros = int(np.count_nonzero(registers == 0))
+    if estimate <= 2.5 * m and zeros:
+        estimate = m * np.log(m / zeros)
+    return int(round(estimate))
+
+def merged_dtype(a, b):
+    """dtype name of a column whose chunks were read as a and b."""
+    if a is None or a == b:
+        return b
+    if {a, b} <= {"int64", "float64"}:
+        return "float64"
+    return "object"
+
+def header_entry(filepath, sample_rows=None):
+    """Catalog entry from the header and the first sample_rows rows (dtypes inferred from the sample)."""
+    source = os.path.abspath(filepath)
+    stat = os.stat(source)
+    sample = pd.read_csv(source, nrows=sample_rows or SCHEMA_SAMPLE_ROWS)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "columns": [str(c) for c in sample.columns],
+            "dtypes": {str(c): str(t) for c, t in sample.dtypes.items()}, "profiled": False,
+            "rows": None, "null_fraction": None, "distinct_estimate": None}
+
+def profile_entry(filepath, chunk_rows=None):
+    """Catalog entry from a full pass over the CSV in chunks: dtypes of the whole file, row count,
+    fraction of null cells and HyperLogLog distinct-count estimate per column."""
+    entry = header_entry(filepath, sample_rows=1)
+    columns = entry["columns"]
+    n_rows, nulls, dtypes, registers = 0, pd.Series(0, index=columns), {}, {}
+    for chunk in pd.read_csv(filepath, chunksize=chunk_rows or JOIN_CHUNK_ROWS, low_memory=False):
+        chunk.columns = columns
+        n_rows += len(chunk)
+        nulls += chunk.isna().sum()
+        for col in columns:
+            dtypes[col] = merged_dtype(dtypes.get(col), str(chunk[col].dtype))
+            chunk_registers = hll_registers(chunk[col])
+            registers[col] = np.maximum(registers[col], chunk_registers) if col in registers else chunk_registers
+    entry.update(profiled=True, rows=n_rows, dtypes={c: dtypes.get(c, entry["dtypes"][c]) for c in columns},
+                 null_fraction={c: round(float(nulls[c]) / n_rows, 6) if n_rows else 0.0 for c in columns},
+                 distinct_estimate={c: hll_estimate(registers[c]) if c in registers else 0 for c in columns})
+    return entry
+
+def refresh_catalog(folder=None):
+    """Profile every CSV in folder (default raw/) that is new or changed since its catalog entry, or
+    only known from its header; drop entries of CSVs that no longer exist. Returns the catalog."""
+    folder = os.path.abspath(folder or RAW_DIR)
+    if not SCHEMA_CATALOG_NAME:
+        print("Schema catalog disabled (SCHEMA_CATALOG_NAME is None)")
+        return {}
+    path = os.path.join(folder, SCHEMA_CATALOG_NAME)
+    catalog = load_catalog(path)
+    sources = sorted(os.path.join(folder, f) for f in os.listdir(folder) if f.lower().endswith(".csv"))
+    refreshed = {}
+    for source in sources:
+        entry = catalog_entry(source, catalog)
+        if entry is None or not entry["profiled"]:
+            t0 = time.perf_counter()
+            refreshed[source] = profile_entry(source)
+            print(f"Profiled {os.path.basename(source)}: {refreshed[source]['rows']} rows in {time.perf_counter() - t0:.2f}s")
+    catalog.update(refreshed)
+    catalog = {source: entry for source, entry in catalog.items() if source in sources}
+    write_catalog(path, catalog)
+    print(f"Schema catalog: {len(sources)} CSVs, {len(refreshed)} profiled ({path})")
+    return catalog
+
+class LazyDataset:
+    """
+    Handle on one raw CSV that exposes its column names and dtypes without loading the file: from the
+    schema catalog when its entry is current, otherwise from the header and a sample (the entry is
+    then saved). The rows are only read by chunks().
+    """
+
+    def __init__(self, filepath, sample_rows=None):
+        self.filepath = filepath
+        # raises FileNotFoundError straight away, like a full load did
+        entry = catalog_entry(filepath)
+        if entry is None:
+            entry = header_entry(filepath, sample_rows)
+            if SCHEMA_CATALOG_NAME:
+                save_catalog_entry(filepath, entry)
+        self.entry = entry
+        self.columns = pd.Index(entry["columns"])
+        self.dtypes = pd.Series(entry["dtypes"])  # whole-file dtypes once profiled, else from the sample
+
+    def chunks(self, columns=None, chunk_rows=None):
+        """The rows of the given columns (all if None) as DataFrames of at most chunk_rows rows,
+        streamed from the CSV as text (as the stream engine reads them, so ids keep their exact
+        spelling) with blank cells as NULL."""
+        chunk_rows = chunk_rows or SQLITE_LOAD_CHUNK_ROWS
+        for chunk in text_chunks(self.filepath, columns, chunk_rows):
+            yield chunk.mask(chunk == "")
+
+    def __repr__(self):
+        state = "profiled" if self.entry["profiled"] else "header + sample"
+        return f"LazyDataset({self.filepath!r}, {len(self.columns)} columns, {state})"
+
+def dataset_path(prefix):
+    """raw/<prefix>.csv"""
+    return os.path.join(RAW_DIR, prefix + ".csv")
 
 def number_tables():
     #First, we need to identify how many tables will be registered.
@@ -24,21 +227,18 @@ def number_tables():
     return n_tables
 
 def source_exctration(n_tables):
-    dfs = {}  # dictionary to store DataFrames with table names as keys
+    dfs = {}  # dictionary to store LazyDataset handles with table names as keys
     
     #Loop source identifying prompts for each table
     for item in range(0,n_tables):
         #First, we need to identify the dataset source:
         while True:
             try:
-                base_dir = os.path.dirname(os.path.abspath(__file__))
                 dataset_source = input(f"Enter CSV prefix for dataset {item+1}:\n").strip()
-                filename = dataset_source + ".csv"
-                filepath = os.path.join(base_dir, "raw", filename)
+                filepath = dataset_path(dataset_source)
                 
-                print("Loading:", filepath, "\n\n")
-                df = pd.read_csv(filepath)
-                dfs[dataset_source] = df  # save with prefix as key
+                print("Opening (header and sample only):", filepath, "\n\n")
+                dfs[dataset_source] = LazyDataset(filepath)  # save with prefix as key
                 break
             except FileNotFoundError:
                 print("File not found. Please check the prefix and try again.\n")
@@ -46,9 +246,12 @@ def source_exctration(n_tables):
                 print(f"\nAn unexpected error occurred: {e}\n")       
     return dfs
 
-def build_sql_select(dfs_dict):
+def build_sql_select(dfs_dict, query=None):
     """
-    Build a basic SQL SELECT statement interactively from the first DataFrame in dfs_dict.
+    Build a basic SQL SELECT statement interactively from the first dataset in dfs_dict
+    (only its column names are needed, so nothing is loaded). Selected columns are qualified with
+    the table name so they stay unambiguous once other tables are joined. If a query dict is given,
+    the choices are recorded in it ("table", "columns", "distinct") for execute_query.
     """
     print(f"Now we will build a basic SQL SELECT statement from the FIRST dataset you input...\n")
     
@@ -72,19 +275,34 @@ def build_sql_select(dfs_dict):
             if invalid_cols:
                 print(f"\nError: The following columns do not exist in the table: {', '.join(invalid_cols)}. Please try again.\n")
                 continue
-    
-        cols_str = ", ".join(columns) if columns != ["*"] else "*"
         break
     
-    cols_str = ", ".join(columns) if columns != ["*"] else "*"
-
+    if query is not None:
+        query.update(table=first_table, columns=columns, distinct=bool(distinct), joins=[])
     # Build SQL
-    sql = f"SELECT {distinct}{cols_str} FROM {first_table};"
+    sql = select_clause(first_table, columns, bool(distinct)) + ";"
     return sql
 
-def build_sql_join(dfs_dict, sql_select):
+def select_clause(table, columns, distinct=False):
+    """SELECT [DISTINCT] of the (table-qualified) columns, or *, FROM table."""
+    cols_str = ", ".join(f"{table}.{col}" for col in columns) if columns != ["*"] else "*"
+    return f"SELECT {'DISTINCT ' if distinct else ''}{cols_str} FROM {table}"
+
+def join_clause(base_table, base_col, join_table, join_col):
+    """One LEFT JOIN of join_table on base_table.base_col = join_table.join_col."""
+    return f"\nLEFT JOIN {join_table} \n\tON {base_table}.{base_col} = {join_table}.{join_col}"
+
+def query_sql(query):
+    """The SQL of a query dict (as recorded by build_sql_select/build_sql_join or given in a job file)."""
+    sql = select_clause(query["table"], query["columns"], query["distinct"])
+    for join_table, base_col, join_col in query["joins"]:
+        sql += join_clause(query["table"], base_col, join_table, join_col)
+    return sql + ";"
+
+def build_sql_join(dfs_dict, sql_select, query=None):
     """
     Appends LEFT JOIN statements to an existing SQL SELECT based on subsequent tables in dfs_dict.
+    Each join is also recorded in query["joins"] as (join_table, base_col, join_col) if a query is given.
     """
     
     tables = list(dfs_dict.keys())
@@ -103,8 +321,18 @@ def build_sql_join(dfs_dict, sql_select):
                 if join_col not in dfs_dict[join_table].columns:
                     print(f"Column '{join_col}' not in {join_table}. Try again.\n")
                     continue
+                if JOIN_PROFILE:
+                    estimate = profile_join(dfs_dict, base_table, base_col, join_table, join_col)
+                    print("Join estimate:", describe_join(estimate))
+                    if estimate["flagged"]:
+                        keep = input("This join multiplies the rows. Keep it anyway? (y/n) [default n]: ").strip().lower()
+                        if keep != "y":
+                            print("Choose other join columns.\n")
+                            continue
 
-                sql += f"\nLEFT JOIN {join_table} \n\tON {base_table}.{base_col} = {join_table}.{join_col}"
+                sql += join_clause(base_table, base_col, join_table, join_col)
+                if query is not None:
+                    query["joins"].append((join_table, base_col, join_col))
                 break
             except Exception as e:
                 print(f"Unexpected error: {e}. Try again.\n")
@@ -116,30 +344,521 @@ def build_sql_join(dfs_dict, sql_select):
 
 
 
-n_tables = number_tables()
-dfs_dict = source_exctration(n_tables)
-sql_select = build_sql_select(dfs_dict)
-sql_joined = sql_select
-print("\n", sql_select)
+def quote_identifier(name):
+    """SQLite identifier quoting (for table/column names taken from CSV prefixes and headers)."""
+    return '"' + str(name).replace('"', '""') + '"'
+
+def query_columns(dfs_dict, query):
+    """The columns execute_query has to load from each table: the selected columns of the base table,
+    every join column, and all columns of every table when the query selects *."""
+    tables = [query["table"]] + [join_table for join_table, _, _ in query["joins"]]
+    select_all = query["columns"] == ["*"]
+    needed = {table: list(dfs_dict[table].columns) if select_all else [] for table in tables}
+    if not select_all:
+        needed[query["table"]] = list(query["columns"])
+    for join_table, base_col, join_col in query["joins"]:
+        for table, col in [(query["table"], base_col), (join_table, join_col)]:
+            if col not in needed[table]:
+                needed[table].append(col)
+    return needed
+
+def execute_query(dfs_dict, query, sql, output_file, database=None):
+    """
+    Run the generated query locally: bulk-load the needed columns of each dataset into SQLite (streamed
+    in chunks unless the table is already loaded), index the join columns of the joined tables (the
+    lookup side of each LEFT JOIN), run sql and stream the result to output_file as CSV.
+    Returns the timings (seconds) and row counts, which are also printed.
+    """
+    database = database or ":memory:"
+    if database != ":memory:" and os.path.exists(database):
+        os.remove(database)  # rebuilt from the current CSVs
+    timings = {"load": {}, "index": {}, "query": None, "rows": {}}
+    con = sqlite3.connect(database)
+    try:
+        for table, columns in query_columns(dfs_dict, query).items():
+            t0 = time.perf_counter()
+            n_rows = 0
+            for chunk in dfs_dict[table].chunks(columns):
+                chunk.to_sql(table, con, if_exists="append" if n_rows else "replace", index=False)
+                n_rows += len(chunk)
+            con.commit()
+            timings["load"][table] = time.perf_counter() - t0
+            timings["rows"][table] = n_rows
+
+        for join_table, _, join_col in query["joins"]:
+            t0 = time.perf_counter()
+            index_name = quote_identifier(f"idx_{join_table}_{join_col}")
+            con.execute(f"CREATE INDEX IF NOT EXISTS {index_name} "
+                        f"ON {quote_identifier(join_table)} ({quote_identifier(join_col)})")
+            timings["index"][f"{join_table}.{join_col}"] = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        cursor = con.execute(sql)
+        os.makedirs(os.path.dirname(output_file), exist_ok=True)
+        n_result = 0
+        with open(output_file, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow([d[0] for d in cursor.description])
+            while True:
+                rows = cursor.fetchmany(SQLITE_LOAD_CHUNK_ROWS)
+                if not rows:
+                    break
+                writer.writerows(rows)
+                n_result += len(rows)
+        timings["query"] = time.perf_counter() - t0
+        timings["rows"]["result"] = n_result
+    finally:
+        con.close()
+
+    for table, seconds in timings["load"].items():
+        print(f"Load  {table}: {timings['rows'][table]} rows in {seconds:.3f}s")
+    for column, seconds in timings["index"].items():
+        print(f"Index {column}: {seconds:.3f}s")
+    print(f"Query: {n_result} rows in {timings['query']:.3f}s (written to {output_file})")
+    return timings
+
+
+# -------------------------
+# Streaming hash join (tables larger than memory, no database)
+# -------------------------
+def text_chunks(filepath, columns=None, chunk_rows=None, names=None):
+    """
+    CSV rows as text (blank cells as "") in DataFrames of at most chunk_rows rows: the given columns
+    of a CSV with a header, or every column of a headerless spill file with the given names.
+    """
+    chunk_rows = chunk_rows or JOIN_CHUNK_ROWS
+    if names is not None:
+        return pd.read_csv(filepath, header=None, names=names, dtype=str, keep_default_na=False,
+                           chunksize=chunk_rows)
+    return pd.read_csv(filepath, usecols=columns, dtype=str, keep_default_na=False, chunksize=chunk_rows)
+
+def table_chunks(dataset, table, columns):
+    """The needed columns of one dataset, renamed to table.column so joined tables never clash."""
+    names = [f"{table}.{col}" for col in columns]
+    for chunk in text_chunks(dataset.filepath, columns):
+        yield chunk[columns].set_axis(names, axis=1)
+
+def read_limited(chunks, names, max_rows):
+    """(frame, None) with every chunk if they hold at most max_rows rows in total, otherwise
+    (None, iterator over all chunks, starting with the ones already read)."""
+    held, n_rows = [], 0
+    for chunk in chunks:
+        held.append(chunk)
+        n_rows += len(chunk)
+        if n_rows > max_rows:
+            return None, itertools.chain(held, chunks)
+    if not held:
+        return pd.DataFrame({name: pd.Series(dtype=str) for name in names}), None
+    return pd.concat(held, ignore_index=True), None
+
+def spill_partitions(chunks, key, n_parts, spill_dir, side):
+    """Append every chunk to spill_dir/<side>_<p>.csv (no header) by the hash of its key column(s).
+    Returns (partition paths, rows spilled); partitions that got no rows have no file."""
+    paths = [os.path.join(spill_dir, f"{side}_{p}.csv") for p in range(n_parts)]
+    n_rows = 0
+    for chunk in chunks:
+        n_rows += len(chunk)
+        part = pd.util.hash_pandas_object(chunk[key], index=False).to_numpy() % n_parts
+        for p, piece in chunk.groupby(part, sort=False):
+            piece.to_csv(paths[p], mode="a", header=False, index=False)
+    return paths, n_rows
+
+def matchable(right, right_key):
+    """Rows of the joined table that can match: a blank key is NULL in SQL and never matches."""
+    return right[right[right_key] != ""]
+
+def left_join_chunk(left, right, left_key, right_key):
+    """LEFT JOIN of one chunk of rows on a hashed right table; unmatched right columns become ""."""
+    return left.merge(right, how="left", left_on=left_key, right_on=right_key, sort=False).fillna("")
+
+def spilled_left_join(left_names, left_chunks, right_names, right_chunks, left_key, right_key, stats):
+    """Grace hash join: both sides are partitioned on the key into spill files, then each left partition
+    streams through its (in-memory) right partition. Rows come out partition by partition."""
+    with tempfile.TemporaryDirectory(prefix="join_spill_", dir=JOIN_SPILL_DIR) as spill_dir:
+        right_paths, stats["right_rows"] = spill_partitions(right_chunks, right_key, JOIN_PARTITIONS, spill_dir, "right")
+        left_paths, _ = spill_partitions(left_chunks, left_key, JOIN_PARTITIONS, spill_dir, "left")
+        for left_path, right_path in zip(left_paths, right_paths):
+            if not os.path.exists(left_path):
+                continue
+            right, _ = read_limited(text_chunks(right_path, names=right_names) if os.path.exists(right_path) else [],
+                                    right_names, float("inf"))
+            right = matchable(right, right_key)
+            for chunk in text_chunks(left_path, names=left_names):
+                yield left_join_chunk(chunk, right, left_key, right_key)
+
+def stream_left_join(left_names, left_chunks, dataset, table, columns, left_key, join_col, stats):
+    """
+    One LEFT JOIN of a stream of rows (left_names columns) with a dataset on left_key = table.join_col.
+    Returns (names, chunks) of the joined rows. The dataset is hashed in memory if it has at most
+    JOIN_MEMORY_ROWS rows, otherwise both sides are spilled (spilled_left_join).
+    """
+    right_names = [f"{table}.{col}" for col in columns]
+    right_key = f"{table}.{join_col}"
+    right, right_chunks = read_limited(table_chunks(dataset, table, columns), right_names, JOIN_MEMORY_ROWS)
+    names = left_names + right_names
+    if right is not None:
+        stats.update(mode="memory", right_rows=len(right))
+        right = matchable(right, right_key)
+        return names, (left_join_chunk(chunk, right, left_key, right_key) for chunk in left_chunks)
+    stats.update(mode=f"spill ({JOIN_PARTITIONS} partitions)")
+    return names, spilled_left_join(left_names, left_chunks, right_names, right_chunks, left_key, right_key, stats)
+
+def distinct_chunks(names, chunks):
+    """Exact DISTINCT of a stream of rows: de-duplicated in memory while there are at most JOIN_MEMORY_ROWS
+    rows, otherwise hash-partitioned on the whole row into spill files and de-duplicated per partition."""
+    held, rest = read_limited(chunks, names, JOIN_MEMORY_ROWS)
+    if held is not None:
+        yield held.drop_duplicates()
+        return
+    with tempfile.TemporaryDirectory(prefix="distinct_spill_", dir=JOIN_SPILL_DIR) as spill_dir:
+        paths, _ = spill_partitions(rest, names, JOIN_PARTITIONS, spill_dir, "rows")
+        for path in paths:
+            if os.path.exists(path):
+                part, _ = read_limited(text_chunks(path, names=names), names, float("inf"))
+                yield part.drop_duplicates()
+
+def stream_join(datasets, query, output_file):
+    """
+    Run a query dict (SELECT [DISTINCT] ... FROM table LEFT JOIN ... chained as the prompts build them)
+    without a database: the needed columns of each CSV are streamed as text, every LEFT JOIN is a
+    streaming hash join (stream_left_join) and the selected columns are written to output_file.
+    Values are written exactly as in the CSVs; keys are compared as text and blank keys never match.
+    Returns the join modes, row counts and seconds, which are also printed.
+    """
+    t0 = time.perf_counter()
+    needed = query_columns(datasets, query)
+    base = query["table"]
+    names = [f"{base}.{col}" for col in needed[base]]
+    chunks = table_chunks(datasets[base], base, needed[base])
+    stats = {"joins": {}, "rows": {}}
+    for join_table, base_col, join_col in query["joins"]:
+        join_stats = stats["joins"][f"{join_table}.{join_col}"] = {}
+        names, chunks = stream_left_join(names, chunks, datasets[join_table], join_table, needed[join_table],
+                                         f"{base}.{base_col}", join_col, join_stats)
+
+    if query["columns"] == ["*"]:
+        selected, header = names, [col for table in needed for col in needed[table]]
+    else:
+        selected, header = [f"{base}.{col}" for col in query["columns"]], list(query["columns"])
+    chunks = (chunk[selected] for chunk in chunks)
+    if query["distinct"]:
+        chunks = distinct_chunks(selected, chunks)
+
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    n_result, wrote_header = 0, False
+    with open(output_file, "w", newline="") as f:
+        for chunk in chunks:
+            chunk.to_csv(f, header=False if wrote_header else header, index=False)
+            n_result += len(chunk)
+            wrote_header = True
+        if not wrote_header:
+            pd.DataFrame(columns=header).to_csv(f, index=False)
+    stats["rows"]["result"] = n_result
+    stats["seconds"] = time.perf_counter() - t0
+
+    for join, join_stats in stats["joins"].items():
+        print(f"Join  {join}: {join_stats['right_rows']} rows, {join_stats['mode']}")
+    print(f"Query: {n_result} rows in {stats['seconds']:.3f}s (written to {output_file})")
+    return stats
+
+# -------------------------
+# Join-key profiling: estimated uniqueness, overlap and output rows of each join
+# -------------------------
+def key_sketch(dataset, column):
+    """
+    Rows, rows with a (non-blank) key and HyperLogLog registers of one key column, read as text like
+    the streaming join compares keys. Stored in the dataset's catalog entry while the CSV is unchanged.
+    """
+    source = os.path.abspath(dataset.filepath)
+    entry = catalog_entry(source)
+    cached = (entry or {}).get("key_sketches", {}).get(column)
+    if cached:
+        registers = np.frombuffer(base64.b64decode(cached["registers"]), dtype=np.uint8)
+        return {"rows": cached["rows"], "keys": cached["keys"], "registers": registers}
+    n_rows, n_keys, registers = 0, 0, np.zeros(1 << HLL_PRECISION, dtype=np.uint8)
+    for chunk in text_chunks(source, [column]):
+        keys = chunk[column][chunk[column] != ""]
+        n_rows += len(chunk)
+        n_keys += len(keys)
+        registers = np.maximum(registers, hll_registers(keys))
+    if entry is not None and catalog_entry(source) is not None:  # unchanged while it was read
+        entry.setdefault("key_sketches", {})[column] = {
+            "rows": n_rows, "keys": n_keys, "registers": base64.b64encode(registers.tobytes()).decode("ascii")}
+        save_catalog_entry(source, entry)
+    return {"rows": n_rows, "keys": n_keys, "registers": registers}
+
+def estimate_join(base, joined):
+    """
+    LEFT JOIN estimate from two key sketches: distinct keys per side, overlap (inclusion-exclusion of the
+    HLL union), rows per key and the output rows, assuming rows are spread evenly over the keys.
+    """
+    base_distinct = hll_estimate(base["registers"])
+    join_distinct = hll_estimate(joined["registers"])
+    union = hll_estimate(np.maximum(base["registers"], joined["registers"]))
+    overlap = max(0, min(base_distinct + join_distinct - union, base_distinct, join_distinct))
+    base_per_key = base["keys"] / base_distinct if base_distinct else 0.0
+    join_per_key = joined["keys"] / join_distinct if join_distinct else 0.0
+    matched = min(overlap * base_per_key, base["keys"])
+    rows = matched * max(join_per_key, 1.0) + (base["rows"] - matched)
+    relationship = "-to-".join("one" if per_key <= 1.05 else "many" for per_key in (base_per_key, join_per_key))
+    return {"base_rows": base["rows"], "join_rows": joined["rows"], "base_distinct": base_distinct,
+            "join_distinct": join_distinct, "overlap": overlap, "base_rows_per_key": round(base_per_key, 2),
+            "join_rows_per_key": round(join_per_key, 2), "relationship": relationship,
+            "estimated_rows": int(round(rows)), "growth": round(rows / base["rows"], 2) if base["rows"] else 0.0}
+
+def profile_join(dfs_dict, base_table, base_col, join_table, join_col):
+    """estimate_join for one join; "flagged" when it grows past FANOUT_FLAG_RATIO times the base rows."""
+    estimate = estimate_join(key_sketch(dfs_dict[base_table], base_col), key_sketch(dfs_dict[join_table], join_col))
+    estimate["join"] = f"{base_table}.{base_col} = {join_table}.{join_col}"
+    estimate["flagged"] = estimate["growth"] > FANOUT_FLAG_RATIO
+    return estimate
+
+def profile_joins(dfs_dict, query):
+    """profile_join for every join of a query, plus the chained estimate after each join (every join
+    multiplies the base rows by its growth)."""
+    estimates, growth = [], 1.0
+    for join_table, base_col, join_col in query["joins"]:
+        estimate = profile_join(dfs_dict, query["table"], base_col, join_table, join_col)
+        growth *= estimate["growth"]
+        estimate["chained_rows"] = int(round(estimate["base_rows"] * growth))
+        estimate["flagged"] = estimate["flagged"] or growth > FANOUT_FLAG_RATIO
+        estimates.append(estimate)
+    return estimates
+
+def describe_join(estimate):
+    """One line summary of a join estimate."""
+    flag = "  <-- FAN-OUT" if estimate["flagged"] else ""
+    return (f"{estimate['join']}: {estimate['relationship']} ({estimate['base_rows_per_key']} / "
+            f"{estimate['join_rows_per_key']} rows per key), ~{estimate['overlap']} shared keys, "
+            f"~{estimate['estimated_rows']} rows ({estimate['growth']}x the base table){flag}")
+
+# -------------------------
+# Batch mode: every query of a job file, without prompts
+# -------------------------
+def load_jobs(job_file):
+    """
+    Read a job file (JSON): a list of jobs, or {"jobs": [...]}. Each job is a query dict like the
+    prompts build, e.g.
+        {"name": "cdrisc", "table": "data_placeholder", "columns": ["randomization", "cdrisc_72"],
+         "distinct": false, "execute": true,
+         "joins": [{"table": "data_placeholder_two", "base_col": "randomization", "join_col": "randomization"}]}
+    "columns" defaults to all (*), "distinct" to false, "joins" to none, "name" to job<n>, "execute"
+    to the --execute flag and "engine" ("sqlite" or "stream") to --engine. "allow_fanout": true lets
+    a job run although a join is flagged by the join-key profile. Joins become
+    (join_table, base_col, join_col) tuples.
+    """
+    with open(job_file) as f:
+        spec = json.load(f)
+    jobs = spec["jobs"] if isinstance(spec, dict) else spec
+    normalized = []
+    for i, job in enumerate(jobs):
+        normalized.append({
+            "name": str(job.get("name") or f"job{i + 1}"),
+            "table": job.get("table"),
+            "columns": list(job.get("columns") or ["*"]),
+            "distinct": bool(job.get("distinct", False)),
+            "joins": [(j.get("table"), j.get("base_col"), j.get("join_col")) for j in job.get("joins", [])],
+            "execute": job.get("execute"),
+            "engine": job.get("engine"),
+            "allow_fanout": bool(job.get("allow_fanout", False)),
+        })
+    return normalized
+
+def open_datasets(jobs):
+    """One LazyDataset per prefix used by any job (header + sample, shared by all jobs).
+    Returns (datasets, {prefix: problem}) for the prefixes that could not be opened."""
+    datasets, problems = {}, {}
+    prefixes = [job["table"] for job in jobs] + [t for job in jobs for t, _, _ in job["joins"]]
+    for prefix in dict.fromkeys(p for p in prefixes if p):
+        try:
+            datasets[prefix] = LazyDataset(dataset_path(prefix))
+        except FileNotFoundError:
+            problems[prefix] = f"file not found: {dataset_path(prefix)}"
+        except Exception as e:
+            problems[prefix] = f"cannot read {dataset_path(prefix)}: {e}"
+    return datasets, problems
+
+def validate_job(job, datasets, dataset_problems):
+    """The problems of one job against the dataset schemas (same checks as the prompts); empty if OK."""
+    problems = []
+    tables = [job["table"]] + [t for t, _, _ in job["joins"]]
+    if not job["table"]:
+        return ["no base table"]
+    for table in dict.fromkeys(tables):
+        if not table:
+            problems.append("join without a table")
+        elif table in dataset_problems:
+            problems.append(dataset_problems[table])
+    if len(set(tables)) != len(tables):
+        problems.append("a table is used more than once")
+    if job.get("engine") not in [None] + ENGINES:
+        problems.append(f"unknown engine '{job['engine']}' (use {' or '.join(ENGINES)})")
+    if problems:
+        return problems
+    base = datasets[job["table"]]
+    if job["columns"] != ["*"]:
+        invalid = [c for c in job["columns"] if c not in base.columns]
+        if invalid:
+            problems.append(f"columns not in {job['table']}: {', '.join(invalid)}")
+    for join_table, base_col, join_col in job["joins"]:
+        if base_col not in base.columns:
+            problems.append(f"column '{base_col}' not in {job['table']}")
+        if join_col not in datasets[join_table].columns:
+            problems.append(f"column '{join_col}' not in {join_table}")
+    if problems or not JOIN_PROFILE:
+        return problems
+    job["join_estimates"] = profile_joins(datasets, job)
+    for estimate in job["join_estimates"]:
+        if estimate["flagged"] and not job["allow_fanout"]:
+            problems.append(f"fan-out: {describe_join(estimate)}; chained estimate ~{estimate['chained_rows']} rows "
+                            f"(set \"allow_fanout\": true to run it anyway)")
+    return problems
+
+def run_job(job, datasets, output_dir, execute, engine="sqlite"):
+    """Write output_dir/<name>.sql and, when the job is executed, <name>.csv with the job's engine
+    (execute_query or stream_join). Returns a summary dict of the job."""
+    sql = query_sql(job)
+    os.makedirs(output_dir, exist_ok=True)
+    sql_file = os.path.join(output_dir, f"{job['name']}.sql")
+    with open(sql_file, "w") as f:
+        f.write(sql)
+    summary = {"name": job["name"], "sql_file": sql_file}
+    if job.get("join_estimates"):
+        summary["join_estimates"] = job["join_estimates"]
+    if job["execute"] if job["execute"] is not None else execute:
+        tables = [job["table"]] + [t for t, _, _ in job["joins"]]
+        job_datasets = {t: datasets[t] for t in tables}
+        result_file = os.path.join(output_dir, f"{job['name']}.csv")
+        summary["engine"] = job["engine"] or engine
+        if summary["engine"] == "stream":
+            summary["timings"] = stream_join(job_datasets, job, result_file)
+        else:
+            database = os.path.join(output_dir, f"{job['name']}.sqlite") if SQLITE_DATABASE else None
+            summary["timings"] = execute_query(job_datasets, job, sql, result_file, database)
+        summary["result_file"] = result_file
+    return summary
+
+def run_batch(job_file, output_dir=None, execute=False, max_workers=None, engine="sqlite"):
+    """
+    Validate every job of job_file against the dataset schemas first (nothing runs if any job is
+    invalid), then write every query (and execute it, see run_job) in one run. With max_workers > 1
+    jobs run in parallel worker processes. Returns (summaries, {job name: problems or error}).
+    """
+    output_dir = output_dir or OUTPUT_DIR
+    jobs = load_jobs(job_file)
+    datasets, dataset_problems = open_datasets(jobs)
+    failures = {}
+    names = [job["name"] for job in jobs]
+    for job in jobs:
+        problems = validate_job(job, datasets, dataset_problems)
+        if names.count(job["name"]) > 1:
+            problems.append("duplicate job name")
+        if problems:
+            failures[job["name"]] = problems
+    if failures:
+        for name, problems in failures.items():
+            for problem in problems:
+                print(f"Job {name}: {problem}")
+        return [], failures
+
+    summaries = {}
+    if max_workers and max_workers > 1 and len(jobs) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            futures = {job["name"]: pool.submit(run_job, job, datasets, output_dir, execute, engine) for job in jobs}
+            for name, future in futures.items():
+                try:
+                    summaries[name] = future.result()
+                except Exception as e:
+                    failures[name] = repr(e)
+    else:
+        for job in jobs:
+            try:
+                summaries[job["name"]] = run_job(job, datasets, output_dir, execute, engine)
+            except Exception as e:
+                failures[job["name"]] = repr(e)
+
+    for name in names:
+        status = f"FAILED: {failures[name]}" if name in failures else "ok"
+        print(f"Job {name}: {status}")
+    summary_file = os.path.join(output_dir, "batch_summary.json")
+    with open(summary_file, "w") as f:
+        json.dump({"job_file": os.path.abspath(job_file), "jobs": [summaries[n] for n in names if n in summaries],
+                   "failures": failures}, f, indent=2)
+    print(f"Batch summary saved to {summary_file}")
+    return [summaries[n] for n in names if n in summaries], failures
+
+# -------------------------
+# Interactive session (prompts)
+# -------------------------
+def interactive():
+    print("Welcome to the Automated Extract and Analyse Tool. Make sure you have SQL and R.\n")
+    n_tables = number_tables()
+    dfs_dict = source_exctration(n_tables)
+    query = {}
+    sql_select = build_sql_select(dfs_dict, query)
+    sql_joined = sql_select
+    print("\n", sql_select)
+
 
+    if n_tables > 1:
+        sql_joined = build_sql_join(dfs_dict, sql_select, query)
+        print("\n", sql_joined)
 
-if n_tables > 1:
-    sql_joined = build_sql_join(dfs_dict, sql_select)
-    print("\n", sql_joined)
 
+    # Make sure the output folder exists
+    output_dir = OUTPUT_DIR
+    os.makedirs(output_dir, exist_ok=True)  # creates folder if it doesn't exist
 
-# Make sure the output folder exists
-base_dir = os.path.dirname(os.path.abspath(__file__))
-output_dir = os.path.join(base_dir, "output")
-os.makedirs(output_dir, exist_ok=True)  # creates folder if it doesn't exist
+    # Define the output file path
+    output_file = os.path.join(output_dir, "joined_query.sql")
 
-# Define the output file path
-output_file = os.path.join(output_dir, "joined_query.sql")
+    # Save the SQL string
+    with open(output_file, "w") as f:
+        f.write(sql_joined)
 
-# Save the SQL string
-with open(output_file, "w") as f:
-    f.write(sql_joined)
+    print(f"SQL saved to {output_file}")
 
-print(f"SQL saved to {output_file}")
+    run_input = input("Run the query locally and write the joined table? (y = SQLite, "
+                      "s = streaming join for tables larger than memory, n) [default n]: ").strip().lower()
+    result_file = os.path.join(output_dir, "joined_result.csv")
+    if run_input == "y":
+        database = os.path.join(output_dir, SQLITE_DATABASE) if SQLITE_DATABASE else None
+        execute_query(dfs_dict, query, sql_joined, result_file, database)
+    elif run_input == "s":
+        stream_join(dfs_dict, query, result_file)
 
+def main(argv=None):
+    """Interactive prompts by default; --jobs runs a job file without prompts."""
+    import argparse
+    parser = argparse.ArgumentParser(description="Build (and optionally run) SELECT/LEFT JOIN queries over raw/ CSVs.")
+    parser.add_argument("--jobs", help="job file (JSON) to run without prompts, see load_jobs()")
+    parser.add_argument("--execute", action="store_true",
+                        help="batch mode: also run every query (jobs can override with \"execute\")")
+    parser.add_argument("--engine", choices=ENGINES, default="sqlite",
+                        help="batch mode: how queries are run (jobs can override with \"engine\"); "
+                             "stream = streaming hash join for tables larger than memory")
+    parser.add_argument("--workers", type=int, help="batch mode: run jobs in this many worker processes")
+    parser.add_argument("--output-dir", help="batch mode: folder for the .sql/.csv files (default: output/)")
+    parser.add_argument("--no-join-profile", action="store_true",
+                        help="skip the join-key fan-out estimates (JOIN_PROFILE)")
+    parser.add_argument("--refresh-catalog", action="store_true",
+                        help="profile new/changed raw/ CSVs into the schema catalog (then run --jobs, if given)")
+    args = parser.parse_args(argv)
+    if args.no_join_profile:
+        global JOIN_PROFILE
+        JOIN_PROFILE = False
+    if args.refresh_catalog:
+        refresh_catalog()
+        if not args.jobs:
+            return 0
+    if args.jobs:
+        _, failures = run_batch(args.jobs, args.output_dir, args.execute, args.workers, args.engine)
+        status = 1 if failures else 0
+    else:
+        interactive()
+        status = 0
+    return status
 
+if __name__ == "__main__":
+    raise SystemExit(main())